@@ -0,0 +1,91 @@
+"""
+Шторм входов: N пользователей логинятся одновременно.
+
+Меряет пропускную способность проверки паролей, задержку одного входа
+и главное — насколько залипает хаб eventlet (сколько опоздал таймер на 10 мс),
+пока считается scrypt. Три прогона:
+  1. scrypt прямо на хабе — как было до пула;
+  2. check_password через пул, кэш пуст;
+  3. check_password повторно — попадания в кэш проверенных паролей.
+
+Запуск из корня репозитория:
+    python bench/login_storm.py [число пользователей, по умолчанию 200]
+
+Сервер импортируется во временной папке — его JSON-базы рабочие данные не трогают.
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import eventlet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TICK = 0.01
+
+def load_server():
+    workdir = tempfile.mkdtemp(prefix='login_storm_')
+    shutil.copy(os.path.join(ROOT, 'server.py'), workdir)
+    shutil.copytree(os.path.join(ROOT, 'templates'), os.path.join(workdir, 'templates'))
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    logging.disable(logging.CRITICAL)
+    import server
+    return server, workdir
+
+def storm(users, check, label):
+    """Все входы разом; параллельно тикер замеряет, на сколько опаздывает хаб."""
+    stalls = []
+    stop = [False]
+
+    def ticker():
+        last = time.perf_counter()
+        while not stop[0]:
+            eventlet.sleep(TICK)
+            now = time.perf_counter()
+            stalls.append(now - last - TICK)
+            last = now
+
+    latencies = []
+
+    def login(username):
+        started = time.perf_counter()
+        assert check(username)
+        latencies.append(time.perf_counter() - started)
+
+    tick = eventlet.spawn(ticker)
+    eventlet.sleep(0)
+    started = time.perf_counter()
+    pool = eventlet.GreenPool(len(users))
+    for username in users:
+        pool.spawn(login, username)
+    pool.waitall()
+    total = time.perf_counter() - started
+    stop[0] = True
+    tick.wait()
+
+    latencies.sort()
+    print(f'{label}: {len(users) / total:.0f} входов/с, '
+          f'p50 {latencies[len(latencies) // 2] * 1000:.0f} мс, '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.0f} мс, '
+          f'залипание хаба до {max(stalls) * 1000:.0f} мс')
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server, workdir = load_server()
+    try:
+        users = [f'u{i}' for i in range(count)]
+        stored = server.hash_password('pw')
+        for username in users:
+            server.users_db[username] = {'password_hash': stored}
+
+        storm(users, lambda u: server.verify_password_hash('pw', stored), 'scrypt на хабе')
+        storm(users, lambda u: server.check_password(u, 'pw'), 'пул, холодный кэш')
+        storm(users, lambda u: server.check_password(u, 'pw'), 'пул, тёплый кэш')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,56 @@
-from flask import Flask, send_file, request, jsonify, session
-from flask_socketio import SocketIO, join_room, leave_room, send, emit
+from flask import Flask, send_file, send_from_directory, request, jsonify, session
+from flask_socketio import SocketIO, join_room, leave_room, rooms, send, emit
 import json
 import os
+import re
 from datetime import datetime, timedelta
 import base64
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import mimetypes
+import multiprocessing
+import secrets
+import signal
+import shutil
+import subprocess
+import sys
+import uuid
+import zlib
+import sqlite3
+import threading
+import time
 from werkzeug.utils import secure_filename
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # без Pillow превью картинок не строятся, оригиналы отдаются как есть
+    Image = None
+
+BOOT_STARTED = time.perf_counter()
+
+# Ключ подписи сессий — из окружения. Без него создаётся случайный и хранится рядом с базами:
+# вшитый в код ключ знает любой, а перезапуск не должен разлогинивать всех.
+SECRET_KEY_FILE = 'secret.key'
+
+def load_secret_key():
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+    if not os.path.exists(SECRET_KEY_FILE):
+        fd = os.open(SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    with open(SECRET_KEY_FILE, 'r') as f:
+        return f.read().strip()
+
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'senator_secret_key_2026'
+app.config['SECRET_KEY'] = load_secret_key()
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
 
 # ВАЖНО: Настройка для Render
@@ -21,16 +64,116 @@ socketio = SocketIO(
     ping_interval=25       # Интервал пинга
 )
 
+# ============ СБОРКА СТРАНИЦЫ ============
+# При старте inline-стили и скрипт из templates/index.html выносятся в отдельные
+# файлы с хешем содержимого в имени. Всё сжимается один раз и лежит в памяти:
+# оболочку браузер перепроверяет по ETag, а ассеты кеширует навсегда.
+try:
+    import brotli
+except ImportError:  # без brotli отдаём gzip
+    brotli = None
+
+TEMPLATE_FILE = 'templates/index.html'
+SHELL_MAX_AGE = 60
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+INLINE_STYLE = re.compile(r'<style>(.*?)</style>', re.S)
+INLINE_SCRIPT = re.compile(r'<script>(.*?)</script>', re.S)
+
+assets = {}  # имя -> {'type', 'etag', 'identity', 'gzip', 'br'}
+page = {}
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+def minify_js(js):
+    # Только безопасные шаги: отступы, пустые строки и строчные комментарии.
+    # Переводы строк остаются, чтобы не ломать автоподстановку точек с запятой.
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+def minify_html(html):
+    return '\n'.join(line.strip() for line in html.splitlines() if line.strip())
+
+def pack_asset(body, content_type):
+    data = body.encode()
+    packed = {'type': content_type, 'etag': hashlib.sha256(data).hexdigest()[:16],
+              'identity': data, 'gzip': gzip.compress(data, 9), 'br': None}
+    if brotli:
+        packed['br'] = brotli.compress(data, quality=11)
+    return packed
+
+def build_page():
+    """Собирает оболочку страницы и версионированные ассеты."""
+    started = time.perf_counter()
+    with open(TEMPLATE_FILE, encoding='utf-8') as f:
+        source = f.read()
+    
+    def extract(pattern, minify, ext, content_type, tag):
+        nonlocal source
+        match = pattern.search(source)
+        if not match:
+            return
+        asset = pack_asset(minify(match.group(1)), content_type)
+        name = f'app.{asset["etag"][:12]}.{ext}'
+        assets[name] = asset
+        source = source[:match.start()] + tag.format(f'/assets/{name}') + source[match.end():]
+        return name
+    
+    names = [extract(INLINE_STYLE, minify_css, 'css', 'text/css; charset=utf-8',
+                     '<link rel="stylesheet" href="{}">'),
+             extract(INLINE_SCRIPT, minify_js, 'js', 'application/javascript; charset=utf-8',
+                     '<script src="{}"></script>')]
+    page.update(pack_asset(minify_html(source), 'text/html; charset=utf-8'))
+    
+    bundle = [page] + [assets[name] for name in names if name]
+    raw = os.path.getsize(TEMPLATE_FILE)
+    best = 'br' if brotli else 'gzip'
+    print(f'📦 Страница собрана за {(time.perf_counter() - started) * 1000:.0f} мс: '
+          f'первая загрузка {sum(len(a[best]) for a in bundle) / 1024:.1f} КБ ({best}), '
+          f'без сжатия {sum(len(a["identity"]) for a in bundle) / 1024:.1f} КБ, '
+          f'исходник {raw / 1024:.1f} КБ; повторный визит — только оболочка '
+          f'{len(page[best]) / 1024:.1f} КБ или 304')
+
+def packed_response(asset, cache_control):
+    accepted = request.accept_encodings
+    encoding = next((e for e in ('br', 'gzip') if asset[e] and accepted[e]), 'identity')
+    response = app.response_class(asset[encoding], mimetype=asset['type'])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(f'{asset["etag"]}-{encoding}')
+    return response.make_conditional(request)
+
+build_page()
+
 # ============ МАРШРУТ ============
 @app.route('/')
 def index():
-    return send_file('templates/index.html')
+    return packed_response(page, f'public, max-age={SHELL_MAX_AGE}, must-revalidate')
+
+@app.route('/assets/<name>')
+def asset_file(name):
+    if name not in assets:
+        return jsonify({'error': 'Not found'}), 404
+    return packed_response(assets[name], f'public, max-age={ASSET_MAX_AGE}, immutable')
 
 # ============ ПАПКИ ДЛЯ ФАЙЛОВ ============
 UPLOAD_FOLDER = 'uploads'
 AVATAR_FOLDER = 'avatars'
+INBOX_FOLDER = 'inbox'
+ARCHIVE_FOLDER = 'archive'
+MEDIA_FOLDER = os.path.join(UPLOAD_FOLDER, 'media')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(MEDIA_FOLDER, exist_ok=True)
 os.makedirs(AVATAR_FOLDER, exist_ok=True)
+os.makedirs(INBOX_FOLDER, exist_ok=True)
+os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
 
 # ============ БАЗЫ ДАННЫХ ============
 USERS_FILE = 'users.json'
@@ -40,19 +183,89 @@ MESSAGES_FILE = 'messages.json'
 BLOCKED_FILE = 'blocked.json'
 BANNED_FILE = 'banned.json'
 GROUPS_FILE = 'groups.json'
+READS_FILE = 'reads.json'
+LAST_SEEN_FILE = 'last_seen.json'
+RETENTION_FILE = 'retention.json'
+EVENTS_FILE = 'events.jsonl'
+MESSAGES_JOURNAL = 'messages.journal.jsonl'
+
+if socketio.async_mode == 'eventlet':
+    from eventlet import tpool
+    from eventlet.semaphore import BoundedSemaphore as PoolSemaphore
+else:
+    tpool = None
+    PoolSemaphore = threading.BoundedSemaphore
+
+def run_blocking(fn, *args):
+    """Блокирующий вызов в системном потоке, чтобы не останавливать хаб eventlet."""
+    return tpool.execute(fn, *args) if tpool else fn(*args)
+
+# Рядом с каждым файлом лежит .sha256 с суммой содержимого и .bak — прошлая целая версия.
+# Запись идёт во временный файл с fsync и подменяется rename, так что обрыв посреди
+# записи не оставляет полупустой users.json.
+def checksum_path(file):
+    return file + '.sha256'
+
+def write_synced(path, payload):
+    with open(path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+def sync_dir(file):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(file)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def read_verified(path):
+    with open(path, 'rb') as f:
+        payload = f.read()
+    # Файлы без суммы (старые или сервер упал до её записи) проверяются только разбором
+    if os.path.exists(checksum_path(path)):
+        with open(checksum_path(path), 'r', encoding='utf-8') as f:
+            if hashlib.sha256(payload).hexdigest() != f.read().strip():
+                raise ValueError('контрольная сумма не совпадает')
+    return json.loads(payload)
 
 def load_json(file, default):
-    if os.path.exists(file):
+    """Читает файл с проверкой суммы; если он повреждён — последнюю целую копию из .bak."""
+    candidates = [path for path in (file, file + '.bak') if os.path.exists(path)]
+    for path in candidates:
         try:
-            with open(file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return default
+            data = read_verified(path)
+        except (OSError, ValueError) as e:
+            print(f'⚠️ {path}: {e}')
+            continue
+        if path != file:
+            print(f'♻️ {file} восстановлен из {path}')
+        return data
+    if candidates:
+        # Пустое значение по умолчанию затёрло бы все данные при первой же записи
+        raise RuntimeError(f'❌ {file} и его резервная копия повреждены')
     return default
 
-def save_json(file, data):
-    with open(file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+file_locks = {}  # файл -> семафор: запись одного файла идёт строго по очереди
+
+def write_json_file(file, payload):
+    tmp = file + '.tmp'
+    write_synced(tmp, payload)
+    if os.path.exists(file):
+        os.replace(file, file + '.bak')
+        if os.path.exists(checksum_path(file)):
+            os.replace(checksum_path(file), checksum_path(file + '.bak'))
+    os.replace(tmp, file)
+    write_synced(checksum_path(tmp), hashlib.sha256(payload).hexdigest().encode())
+    os.replace(checksum_path(tmp), checksum_path(file))
+    sync_dir(file)
+
+def save_json(file, data, indent=2):
+    """Снимок сериализуется сразу, а запись с fsync уходит в системный поток."""
+    payload = json.dumps(data, ensure_ascii=False, indent=indent).encode('utf-8')
+    with file_locks.setdefault(file, PoolSemaphore(1)):
+        run_blocking(write_json_file, file, payload)
 
 # Загружаем все данные
 users_db = load_json(USERS_FILE, {})
@@ -63,7 +276,112 @@ blocked_db = load_json(BLOCKED_FILE, {})
 banned_db = load_json(BANNED_FILE, {})
 groups_db = load_json(GROUPS_FILE, {})
 
-online_users = {}
+# ============ ОТЛОЖЕННАЯ ЗАПИСЬ ============
+# Файлы не пишутся на каждое событие: изменение помечает хранилище грязным,
+# а фоновый сброс пишет его не чаще interval. При остановке пишется всё.
+# Новые сообщения между сбросами дописываются строкой в журнал: после падения
+# процесса (kill -9, OOM) они восстанавливаются из него при старте.
+STORE_FLUSH_INTERVAL = 2
+
+stores = {}  # файл -> {'data': функция, возвращающая объект, 'interval', 'indent', 'journal', 'flush', 'saved'}
+dirty_stores = set()
+
+def register_store(file, data=None, interval=STORE_FLUSH_INTERVAL, indent=2, journal=None, flush=None):
+    """flush — своя запись вместо JSON-снимка (для хранилищ, которые дописываются, а не переписываются)."""
+    stores[file] = {'data': data, 'interval': interval, 'indent': indent, 'journal': journal,
+                    'flush': flush, 'saved': time.monotonic()}
+
+def mark_dirty(file):
+    dirty_stores.add(file)
+
+def journal_append(file, record):
+    with open(stores[file]['journal'], 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    mark_dirty(file)
+
+def rotate_journal(journal):
+    """Откладывает журнал, покрытый текущим снимком; новые строки пойдут в свежий файл."""
+    if not os.path.exists(journal):
+        return
+    if os.path.exists(journal + '.old'):
+        # Прошлая запись снимка не удалась — копим оба журнала до успешной
+        with open(journal, 'rb') as src, open(journal + '.old', 'ab') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(journal)
+    else:
+        os.replace(journal, journal + '.old')
+
+def read_journal(journal):
+    records = []
+    for path in (journal + '.old', journal):
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue  # строка, оборванная падением
+    return records
+
+def flush_store(file):
+    store = stores[file]
+    with file_locks.setdefault(file, PoolSemaphore(1)):
+        dirty_stores.discard(file)
+        if store['flush']:
+            store['flush']()
+        else:
+            # Снимок и поворот журнала — без переключений, так что журнал покрывает ровно хвост
+            payload = json.dumps(store['data'](), ensure_ascii=False, indent=store['indent']).encode('utf-8')
+            if store['journal']:
+                rotate_journal(store['journal'])
+            run_blocking(write_json_file, file, payload)
+            if store['journal'] and os.path.exists(store['journal'] + '.old'):
+                os.remove(store['journal'] + '.old')
+    store['saved'] = time.monotonic()
+
+def flush_stores(force=False):
+    now = time.monotonic()
+    for file in list(dirty_stores):
+        if force or now - stores[file]['saved'] >= stores[file]['interval']:
+            flush_store(file)
+
+def store_flusher():
+    while True:
+        socketio.sleep(1)
+        flush_stores()
+
+# messages.json самый большой и читается на каждом старте — пишем без отступов
+register_store(MESSAGES_FILE, lambda: messages_db, indent=None, journal=MESSAGES_JOURNAL)
+register_store(USERS_FILE, lambda: users_db)
+register_store(FRIENDS_FILE, lambda: friends_db)
+register_store(BLOCKED_FILE, lambda: blocked_db)
+register_store(BANNED_FILE, lambda: banned_db)
+register_store(GROUPS_FILE, lambda: groups_db)
+socketio.start_background_task(store_flusher)
+
+# Сообщения, записанные в журнал после последнего снимка
+_replayed = 0
+for msg in read_journal(MESSAGES_JOURNAL):
+    room_id = msg.get('room', 'general')
+    if room_id == 'general':
+        messages = messages_db.setdefault('general', [])
+    elif room_id.startswith('group_'):
+        if room_id not in groups_db:
+            continue
+        messages = messages_db.setdefault('groups', {}).setdefault(room_id, [])
+    else:
+        messages = messages_db.setdefault('private', {}).setdefault(room_id, [])
+    # Вытеснение в архив всегда оставляет последнее сообщение, так что сравнения с ним хватает
+    if not messages or msg['seq'] > messages[-1].get('seq', 0):
+        messages.append(msg)
+        _replayed += 1
+if _replayed:
+    print(f'♻️ Из журнала восстановлено сообщений: {_replayed}')
+    mark_dirty(MESSAGES_FILE)
+
+online_users = {}  # sid -> username
+user_sids = {}     # username -> {sid}
+online_list = {}   # username -> запись для user_list, обновляется точечно
 admins = ["SENATOR"]  # Только SENATOR админ
 user_last_seen = {}
 
@@ -77,43 +395,412 @@ for username in users_db:
         users_db[username]['last_seen'] = datetime.now().isoformat()
     if 'avatar' not in users_db[username]:
         users_db[username]['avatar'] = '👤'
-save_json(FRIENDS_FILE, friends_db)
-save_json(BLOCKED_FILE, blocked_db)
-save_json(USERS_FILE, users_db)
+mark_dirty(FRIENDS_FILE)
+mark_dirty(BLOCKED_FILE)
+mark_dirty(USERS_FILE)
+
+# ============ ИНДЕКС ГРУПП ============
+# Списки в groups_db хранят порядок и пишутся на диск, множества — для проверок за O(1)
+user_groups = {}    # username -> {group_id}
+group_members = {}  # group_id -> {username}
+group_admins = {}   # group_id -> {username}
+
+def index_group(group_id):
+    group = groups_db[group_id]
+    group_members[group_id] = set(group['members'])
+    group_admins[group_id] = set(group['admins'])
+    for member in group['members']:
+        user_groups.setdefault(member, set()).add(group_id)
+
+def unindex_group(group_id):
+    for member in group_members.pop(group_id, set()):
+        user_groups.get(member, set()).discard(group_id)
+    group_admins.pop(group_id, None)
+
+def add_group_member(group_id, username):
+    if username in group_members[group_id]:
+        return False
+    groups_db[group_id]['members'].append(username)
+    group_members[group_id].add(username)
+    user_groups.setdefault(username, set()).add(group_id)
+    return True
+
+def remove_group_member(group_id, username):
+    if username not in group_members[group_id]:
+        return False
+    group = groups_db[group_id]
+    group['members'].remove(username)
+    group_members[group_id].discard(username)
+    user_groups.get(username, set()).discard(group_id)
+    if username in group_admins[group_id]:
+        group['admins'].remove(username)
+        group_admins[group_id].discard(username)
+    return True
+
+def is_group_admin(group_id, username):
+    return username in group_admins[group_id] or username == groups_db[group_id]['creator']
+
+def new_group_id():
+    while True:
+        group_id = f"group_{int(time.time())}_{secrets.token_hex(4)}"
+        if group_id not in groups_db:
+            return group_id
+
+# Раньше add_to_group не проверял имя — в groups.json мог попасть None или несуществующий пользователь
+for group_id, group in groups_db.items():
+    known = [m for m in group['members'] if m in users_db]
+    if len(known) != len(group['members']):
+        group['members'] = known
+        mark_dirty(GROUPS_FILE)
+    index_group(group_id)
+
+# ============ РЕЕСТР КОМНАТ ============
+# members/writers — frozenset допущенных пользователей; None — комната открыта всем
+Room = namedtuple('Room', 'id kind members writers')
+
+room_cache = {}     # room id (как прислал клиент) -> Room
+rooms_by_user = {}  # username -> {room id}, чтобы сбрасывать кэш точечно
+
+# Имена могут содержать '_', поэтому перед первым именем стоит его длина:
+# private_<длина A>_A_B однозначен, а старый private_A_B — нет (a + b_c и a_b + c).
+def private_room_id(user1, user2):
+    first, second = sorted((user1, user2))
+    return f"private_{len(first)}_{first}_{second}"
+
+def legacy_private_pairs(room_id):
+    rest = room_id[len('private_'):]
+    return [(rest[:i], rest[i + 1:]) for i, ch in enumerate(rest)
+            if ch == '_' and rest[:i] in users_db and rest[i + 1:] in users_db]
+
+def split_private_room(room_id):
+    """private_<n>_A_B -> (A, B); старый формат принимается, только если разбор единственный."""
+    length, _, rest = room_id[len('private_'):].partition('_')
+    if length.isascii() and length.isdigit():
+        n = int(length)
+        first, second = rest[:n], rest[n + 1:]
+        if rest[n:n + 1] == '_' and first in users_db and second in users_db:
+            return first, second
+    pairs = legacy_private_pairs(room_id)
+    return pairs[0] if len(pairs) == 1 else None
+
+def build_room(room_id):
+    if room_id == 'general':
+        return Room('general', 'general', None, None)
+    if room_id.startswith('private_'):
+        pair = split_private_room(room_id)
+        if not pair or pair[0] == pair[1]:
+            return None
+        user1, user2 = pair
+        members = frozenset(pair)
+        blocked = user2 in blocked_db.get(user1, []) or user1 in blocked_db.get(user2, [])
+        writers = frozenset() if blocked else members - banned_db.keys()
+        return Room(private_room_id(user1, user2), 'private', members, writers)
+    if room_id in groups_db:
+        members = frozenset(group_members[room_id])
+        return Room(room_id, 'group', members, members - banned_db.keys())
+    return None
+
+def resolve_room(room_id):
+    """Разбирает id комнаты один раз; дальше проверки прав — поиск в множестве."""
+    room = room_cache.get(room_id)
+    if room is None and isinstance(room_id, str):
+        room = build_room(room_id)
+        if room:
+            room_cache[room_id] = room
+            for member in room.members or ():
+                rooms_by_user.setdefault(member, set()).add(room_id)
+    return room
+
+def can_read(room, username):
+    return room.members is None or username in room.members
+
+def can_write(room, username):
+    return room.writers is None or username in room.writers
+
+def invalidate_rooms(*usernames):
+    for username in usernames:
+        for room_id in rooms_by_user.pop(username, set()):
+            room_cache.pop(room_id, None)
+
+def invalidate_room(room_id):
+    room_cache.pop(room_id, None)
+
+def room_messages(room, create=False):
+    if room.kind == 'general':
+        bucket = messages_db
+    else:
+        bucket = messages_db.setdefault('private' if room.kind == 'private' else 'groups', {})
+    if create:
+        return bucket.setdefault(room.id, [])
+    return bucket.get(room.id, [])
+
+# Старые ключи личных чатов переводим в каноничный формат: private_<я>_<собеседник>
+# от старого клиента и неоднозначный private_A_B. Спорный ключ разбирается по авторам
+# сообщений. Старый id -> новый остаётся в legacy_private_ids для прочтений, журнала и архива.
+legacy_private_ids = {}
+for room_id in list(messages_db.get('private', {})):
+    messages = messages_db['private'][room_id]
+    pair = split_private_room(room_id)
+    if pair is None:
+        authors = {m.get('username') for m in messages}
+        pairs = [p for p in legacy_private_pairs(room_id) if authors <= set(p)]
+        pair = pairs[0] if len(pairs) == 1 else None
+    if not pair or pair[0] == pair[1] or private_room_id(*pair) == room_id:
+        continue
+    new_id = private_room_id(*pair)
+    legacy_private_ids[room_id] = new_id
+    messages_db['private'].pop(room_id)
+    if new_id in messages_db['private']:
+        merged = messages_db['private'][new_id] + messages
+        merged.sort(key=lambda m: m.get('id', 0))
+        for msg in merged:
+            msg.pop('seq', None)  # номера двух историй пересекаются — пересчитываем ниже
+        messages = merged
+    messages_db['private'][new_id] = messages
+if legacy_private_ids:
+    mark_dirty(MESSAGES_FILE)
+
+def canonical_room_id(room_id):
+    if room_id in legacy_private_ids:
+        return legacy_private_ids[room_id]
+    room = resolve_room(room_id) if room_id.startswith('private_') else None
+    return room.id if room else room_id
+
+def iter_room_lists():
+    yield 'general', messages_db.setdefault('general', [])
+    for kind in ('private', 'groups'):
+        yield from messages_db.setdefault(kind, {}).items()
+
+# Порядковый номер сообщения в комнате: растёт монотонно и не сбрасывается при обрезке
+# истории, поэтому число непрочитанных — разность двух чисел.
+room_seq = {}       # room id -> seq последнего сообщения
+user_dm_rooms = {}  # username -> {id личных чатов}
+for room_id, messages in iter_room_lists():
+    seq = 0
+    for msg in messages:
+        seq = msg.setdefault('seq', seq + 1)
+    room_seq[room_id] = seq
+    if room_id.startswith('private_'):
+        room = resolve_room(room_id)
+        for member in room.members if room else ():
+            user_dm_rooms.setdefault(member, set()).add(room_id)
 
 # ============ ВСПОМОГАТЕЛЬНЫЕ ============
+# last_seen меняется на каждом входе и выходе — держим его отдельно от users.json
+# с аватарками и пишем редко; в users.json остаётся значение на момент переноса.
+LAST_SEEN_SAVE_INTERVAL = 30
+last_seen_db = load_json(LAST_SEEN_FILE, {})
+register_store(LAST_SEEN_FILE, lambda: last_seen_db, interval=LAST_SEEN_SAVE_INTERVAL)
+
+def last_seen_of(u):
+    return last_seen_db.get(u) or users_db[u].get('last_seen', '')
+
+def user_list_entry(u):
+    return {
+        'username': u, 
+        'display_name': users_db[u].get('display_name', u), 
+        'is_admin': users_db[u].get('is_admin', False),
+        'avatar': users_db[u].get('avatar', '👤'),
+        'last_seen': last_seen_of(u)
+    }
+
+# Справочник для all_users: записи общие для всех и обновляются на месте, список
+# пересобирается только при изменении состава. Версия растёт при смене состава, имени
+# или аватарки; переподключившийся клиент с той же версией список не получает заново.
+# Клиент помнит версию и через перезапуск сервера, поэтому в ней есть метка процесса:
+# счётчик нового процесса со старым не совпадёт.
+directory = {}  # username -> {'username', 'display_name', 'avatar', 'last_seen'}
+directory_cache = {'boot': secrets.token_hex(4), 'version': 1, 'users': None}
+
+def refresh_directory(username, bump=True):
+    if username in users_db and username not in banned_db:
+        entry = directory.get(username)
+        if entry is None:
+            entry = directory[username] = {'username': username}
+            directory_cache['users'] = None
+        entry.update(display_name=users_db[username].get('display_name', username),
+                     avatar=users_db[username].get('avatar', '👤'),
+                     last_seen=last_seen_of(username))
+    elif directory.pop(username, None) is not None:
+        directory_cache['users'] = None
+    if bump:
+        directory_cache['version'] += 1
+
+def directory_version():
+    return f"{directory_cache['boot']}.{directory_cache['version']}"
+
+def directory_users():
+    if directory_cache['users'] is None:
+        directory_cache['users'] = list(directory.values())
+    return directory_cache['users']
+
+for _username in users_db:
+    refresh_directory(_username, bump=False)
+
+def set_online(sid, username):
+    online_users[sid] = username
+    user_sids.setdefault(username, set()).add(sid)
+    online_list[username] = user_list_entry(username)
+
+def set_offline(sid):
+    username = online_users.pop(sid, None)
+    sids = user_sids.get(username)
+    if sids is not None:
+        sids.discard(sid)
+        if not sids:
+            del user_sids[username]
+            online_list.pop(username, None)
+    return username
+
 def broadcast_user_list():
-    user_list = []
-    for sid, u in online_users.items():
-        if u not in banned_db:
-            user_list.append({
-                'username': u, 
-                'display_name': users_db[u].get('display_name', u), 
-                'is_admin': users_db[u].get('is_admin', False),
-                'avatar': users_db[u].get('avatar', '👤'),
-                'last_seen': users_db[u].get('last_seen', '')
-            })
-    emit('user_list', user_list, broadcast=True)
+    emit('user_list', list(online_list.values()), broadcast=True)
 def get_all_users(current_user):
-    users = []
-    for username in users_db:
-        if username != current_user and username not in banned_db:
-            users.append({
-                'username': username,
-                'display_name': users_db[username].get('display_name', username),
-                'avatar': users_db[username].get('avatar', '👤'),
-                'is_friend': username in friends_db.get(current_user, {}).get('friends', []),
-                'is_blocked': username in blocked_db.get(current_user, []),
-                'pending_out': username in friends_db.get(current_user, {}).get('pending_out', []),
-                'pending_in': username in friends_db.get(current_user, {}).get('pending_in', []),
-                'last_seen': users_db[username].get('last_seen', '')
-            })
-    return users
+    """Справочник с отношениями к current_user — для поиска."""
+    relations = friends_db.get(current_user, {})
+    blocked = blocked_db.get(current_user, [])
+    return [{
+        **entry,
+        'is_friend': entry['username'] in relations.get('friends', []),
+        'is_blocked': entry['username'] in blocked,
+        'pending_out': entry['username'] in relations.get('pending_out', []),
+        'pending_in': entry['username'] in relations.get('pending_in', []),
+    } for entry in directory_users() if entry['username'] != current_user]
 
 def update_last_seen(username):
     if username in users_db:
-        users_db[username]['last_seen'] = datetime.now().isoformat()
-        save_json(USERS_FILE, users_db)
+        last_seen_db[username] = datetime.now().isoformat()
+        mark_dirty(LAST_SEEN_FILE)
+        if username in directory:
+            directory[username]['last_seen'] = last_seen_db[username]
+
+# ============ ОГРАНИЧЕНИЕ ЧАСТОТЫ ============
+# Бюджеты событий: (токенов в секунду, размер корзины)
+RATE_LIMITS = {
+    'message': (2.0, 10),
+    'search_users': (1.0, 5),
+    'upload_avatar': (0.1, 3),
+    'request_clear_chat': (0.05, 2),
+}
+# Объём медиа: (байт в секунду, размер корзины)
+MEDIA_BYTE_LIMIT = (1024 * 1024, 70 * 1024 * 1024)
+# Сколько тяжёлых операций (запись истории, поиск, аватарки) выполняется одновременно
+MAX_EXPENSIVE_OPS = int(os.environ.get('MAX_EXPENSIVE_OPS', 8))
+# Путь к sqlite-файлу, общему для нескольких воркеров на одной машине
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE')
+
+class MemoryRateStore:
+    """Token bucket в памяти процесса."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost):
+        """Списывает cost токенов; возвращает 0 или сколько секунд ждать."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, stamp = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / rate
+
+    def forget(self, keys):
+        with self.lock:
+            for key in keys:
+                self.buckets.pop(key, None)
+
+class SqliteRateStore:
+    """Token bucket в sqlite: корзины общие для всех воркеров на машине."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, stamp REAL)')
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost):
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT tokens, stamp FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens, stamp = row if row else (burst, now)
+                tokens = min(burst, tokens + max(0, now - stamp) * rate)
+                wait = 0 if tokens >= cost else (cost - tokens) / rate
+                if not wait:
+                    tokens -= cost
+                self.db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, tokens, now))
+            finally:
+                self.db.execute('COMMIT')
+        return wait
+
+    def forget(self, keys):
+        with self.lock:
+            self.db.executemany('DELETE FROM buckets WHERE key = ?', [(key,) for key in keys])
+
+rate_store = SqliteRateStore(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else MemoryRateStore()
+expensive_slots = threading.BoundedSemaphore(MAX_EXPENSIVE_OPS)
+
+def is_media(msg):
+    return bool(msg) and isinstance(msg, str) and msg.startswith(
+        ('data:image', 'data:video', 'data:audio', 'data:application'))
+
+def take_rate(event, owners, cost=1, limits=None):
+    """Проверяет корзины всех владельцев (sid, пользователь, ip); 0 — можно."""
+    rate, burst = limits or RATE_LIMITS[event]
+    cost = min(cost, burst)
+    for owner in owners:
+        wait = rate_store.take(f'{event}:{owner}', rate, burst, cost)
+        if wait:
+            return wait
+    return 0
+
+def socket_owners():
+    owners = [f'sid:{request.sid}']
+    if request.sid in online_users:
+        owners.append(f'user:{online_users[request.sid]}')
+    return owners
+
+def rate_limit_exceeded(event, media_bytes=0):
+    """Для сокет-событий: при превышении отправляет rate_limited и возвращает True."""
+    owners = socket_owners()
+    wait = take_rate(event, owners)
+    if not wait and media_bytes:
+        wait = take_rate('media_bytes', owners, media_bytes, MEDIA_BYTE_LIMIT)
+    if wait:
+        emit('rate_limited', {'event': event, 'retry_after': round(wait, 1)})
+        return True
+    return False
+
+def limit_rate(event, media_cost=None, expensive=False):
+    """Декоратор сокет-обработчика: бюджет события, байты медиа и общий лимит тяжёлых операций."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            data = args[0] if args and isinstance(args[0], dict) else {}
+            if rate_limit_exceeded(event, media_cost(data) if media_cost else 0):
+                return
+            if not expensive:
+                return handler(*args)
+            if not expensive_slots.acquire(blocking=False):
+                emit('rate_limited', {'event': event, 'retry_after': 1, 'reason': 'busy'})
+                return
+            try:
+                return handler(*args)
+            finally:
+                expensive_slots.release()
+        return wrapper
+    return decorator
+
+def message_media_cost(data):
+    msg = data.get('msg')
+    return len(msg) if is_media(msg) else 0
+
+def forget_sid_limits(sid):
+    rate_store.forget([f'{event}:sid:{sid}' for event in list(RATE_LIMITS) + ['media_bytes']])
 
 # ============ ЗАГРУЗКА ФАЙЛОВ ============
 @app.route('/upload', methods=['POST'])
@@ -124,6 +811,10 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No filename'}), 400
     
+    wait = take_rate('media_bytes', [f'ip:{request.remote_addr}'], request.content_length or 0, MEDIA_BYTE_LIMIT)
+    if wait:
+        return jsonify({'error': 'rate_limited', 'retry_after': round(wait, 1)}), 429
+    
     filename = secure_filename(file.filename)
     filepath = os.path.join(UPLOAD_FOLDER, filename)
     file.save(filepath)
@@ -139,8 +830,22 @@ def upload_avatar():
     if not username or not image_data:
         return jsonify({'error': 'No data'}), 400
     
-    users_db[username]['avatar'] = image_data
-    save_json(USERS_FILE, users_db)
+    owners = [f'user:{username}', f'ip:{request.remote_addr}']
+    wait = take_rate('upload_avatar', owners) or \
+        take_rate('media_bytes', owners, len(image_data), MEDIA_BYTE_LIMIT)
+    if wait:
+        return jsonify({'error': 'rate_limited', 'retry_after': round(wait, 1)}), 429
+    
+    if not expensive_slots.acquire(blocking=False):
+        return jsonify({'error': 'rate_limited', 'retry_after': 1}), 429
+    try:
+        users_db[username]['avatar'] = image_data
+        mark_dirty(USERS_FILE)
+        refresh_directory(username)
+        if username in online_list:
+            online_list[username] = user_list_entry(username)
+    finally:
+        expensive_slots.release()
     
     for sid, user in online_users.items():
         emit('avatar_updated', {'username': username, 'avatar': image_data}, room=sid)
@@ -151,6 +856,79 @@ def upload_avatar():
 def uploaded_file(filename):
     return send_file(os.path.join(UPLOAD_FOLDER, filename))
 
+# ============ ПАРОЛИ ============
+# scrypt с n=2**14, r=8 — около 16MB памяти и десятков мс CPU на проверку
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+# Сколько хешей считается одновременно; остальные логины ждут в очереди
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 4))
+VERIFIED_CACHE_SIZE = 1024
+VERIFIED_CACHE_TTL = 15 * 60
+
+hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+hash_slots = PoolSemaphore(HASH_WORKERS)
+verified_cache = OrderedDict()  # username -> (отпечаток пароля, срок действия)
+VERIFIED_CACHE_KEY = secrets.token_bytes(32)
+
+def run_in_pool(fn, *args):
+    """Считает хеш пароля в системном потоке, чтобы не блокировать хаб eventlet.
+    
+    Слоты только для хешей: прочая тяжёлая работа идёт через run_blocking и логины не задерживает.
+    """
+    with hash_slots:
+        if tpool:
+            return tpool.execute(fn, *args)
+        return hash_pool.submit(fn, *args).result()
+
+def hash_password(password):
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+    return '$'.join(['scrypt', str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+                     base64.b64encode(salt).decode(), base64.b64encode(digest).decode()])
+
+def verify_password_hash(password, stored):
+    try:
+        algo, n, r, p, salt, digest = stored.split('$')
+        expected = base64.b64decode(digest)
+        actual = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt),
+                                n=int(n), r=int(r), p=int(p), dklen=len(expected))
+    except (ValueError, TypeError):
+        return False
+    return algo == 'scrypt' and hmac.compare_digest(actual, expected)
+
+def password_fingerprint(username, password, stored):
+    return hmac.new(VERIFIED_CACHE_KEY, f'{username}\0{password}\0{stored}'.encode(), 'sha256').digest()
+
+def remember_verified(username, fingerprint):
+    verified_cache[username] = (fingerprint, time.monotonic() + VERIFIED_CACHE_TTL)
+    verified_cache.move_to_end(username)
+    while len(verified_cache) > VERIFIED_CACHE_SIZE:
+        verified_cache.popitem(last=False)
+
+def check_password(username, password):
+    """Проверяет пароль; записи со старым открытым паролем перехешируются при входе."""
+    user = users_db[username]
+    stored = user.get('password_hash')
+    
+    if stored is None:
+        if not hmac.compare_digest(user.get('password', '').encode(), password.encode()):
+            return False
+        user['password_hash'] = run_in_pool(hash_password, password)
+        user.pop('password', None)
+        mark_dirty(USERS_FILE)
+        remember_verified(username, password_fingerprint(username, password, user['password_hash']))
+        return True
+    
+    fingerprint = password_fingerprint(username, password, stored)
+    cached = verified_cache.get(username)
+    if cached and cached[1] > time.monotonic() and hmac.compare_digest(cached[0], fingerprint):
+        verified_cache.move_to_end(username)
+        return True
+    
+    if not run_in_pool(verify_password_hash, password, stored):
+        return False
+    remember_verified(username, fingerprint)
+    return True
+
 # ============ РЕГИСТРАЦИЯ ============
 @socketio.on('register')
 def handle_register(data):
@@ -171,20 +949,27 @@ def handle_register(data):
         emit('register_error', {'msg': '❌ Это имя уже занято!'})
         return
     
+    password_hash = run_in_pool(hash_password, password)
+    # Пока считался хеш, имя мог занять параллельный запрос
+    if username in users_db:
+        emit('register_error', {'msg': '❌ Это имя уже занято!'})
+        return
+    
     users_db[username] = {
-        "password": password,
+        "password_hash": password_hash,
         "display_name": display_name,
         "avatar": avatar,
         "created": datetime.now().isoformat(),
         "last_seen": datetime.now().isoformat(),
         "is_admin": username in admins
     }
-    save_json(USERS_FILE, users_db)
-    
     friends_db[username] = {"friends": [], "pending_in": [], "pending_out": []}
     blocked_db[username] = []
-    save_json(FRIENDS_FILE, friends_db)
-    save_json(BLOCKED_FILE, blocked_db)
+    # Новый аккаунт пишем сразу (запись идёт вне хаба), остальное — отложенно
+    flush_store(USERS_FILE)
+    refresh_directory(username)
+    mark_dirty(FRIENDS_FILE)
+    mark_dirty(BLOCKED_FILE)
     
     emit('register_success', {'username': username})
 
@@ -203,25 +988,34 @@ def handle_login(data):
         emit('login_error', {'msg': '❌ Пользователь не найден'})
         return
     
-    if users_db[username]['password'] != password:
+    if not check_password(username, password):
         emit('login_error', {'msg': '❌ Неверный пароль'})
         return
     
-    for sid, user in online_users.items():
-        if user == username:
-            emit('login_error', {'msg': '❌ Уже в сети'})
-            return
+    if username in user_sids:
+        emit('login_error', {'msg': '❌ Уже в сети'})
+        return
     
-    online_users[request.sid] = username
+    enter_chat(username, f'✨ {users_db[username]["display_name"]} (@{username}) присоединился',
+               create_session(username) if remember else None)
+
+def enter_chat(username, greeting, session_token=None, resume=None, users_version=None):
+    """Общий вход после проверки пароля или токена.
+    
+    resume — {'room', 'since', 'after'} от переподключившегося клиента: вместо
+    истории общего чата ему досылаются только изменения в его комнате.
+    """
+    was_online = username in user_sids
+    set_online(request.sid, username)
     update_last_seen(username)
     
-    if remember:
-        sessions_db[request.sid] = username
-        save_json(SESSIONS_FILE, sessions_db)
-    
-    join_room('general')
-    
-    emit('history', messages_db['general'][-100:])
+    # Сокет состоит ровно в одной комнате — в той, что открыта у клиента
+    room = resolve_room(resume.get('room')) if resume else None
+    if not room or not can_read(room, username):
+        room = resolve_room('general')
+        resume = {}
+    join_room(room.id)
+    send_room_state(room, resume.get('since'), resume.get('after'))
     
     emit('login_success', {
         'username': username,
@@ -230,55 +1024,111 @@ def handle_login(data):
         'is_admin': users_db[username].get('is_admin', False),
         'friends': friends_db.get(username, {}).get('friends', []),
         'pending_in': friends_db.get(username, {}).get('pending_in', []),
-        'blocked': blocked_db.get(username, [])
+        'blocked': blocked_db.get(username, []),
+        'session_token': session_token
     })
+    emit('unread_counts', unread_counts(username))
     
-    send({
-        'username': '🔵 Система',
-        'msg': f'✨ {users_db[username]["display_name"]} (@{username}) присоединился',
-        'time': datetime.now().strftime('%H:%M'),
-        'type': 'system'
-    }, room='general')
+    missed, truncated = drain_inbox(username)
+    # Открытую комнату клиент уже догнал через send_room_state
+    missed = [m for m in missed if m['room'] != room.id]
+    if missed:
+        emit('offline_messages', {'messages': missed, 'truncated': truncated})
+    
+    # Второй сокет того же пользователя список онлайн не меняет
+    if not was_online:
+        send({
+            'username': '🔵 Система',
+            'msg': greeting,
+            'time': datetime.now().strftime('%H:%M'),
+            'type': 'system'
+        }, room='general')
+        broadcast_user_list()
     
-    broadcast_user_list()
-    emit('all_users', get_all_users(username), room=request.sid)
+    # Общий список отдаётся как есть; себя и отношения клиент учитывает сам
+    fresh = users_version != directory_version()
+    emit('all_users', {
+        'version': directory_version(),
+        'users': directory_users() if fresh else None,
+        'pending_out': friends_db.get(username, {}).get('pending_out', [])
+    }, room=request.sid)
+
+# ============ СЕССИИ ============
+SESSION_TTL = 30 * 24 * 3600
+SESSION_SWEEP_INTERVAL = 60
+
+# Старый sessions.json хранил {sid: username}; sid меняется при каждом подключении,
+# так что такие записи ни разу не срабатывали — отбрасываем их.
+sessions_db = {sid: s for sid, s in sessions_db.items() if isinstance(s, dict)}
+session_expiry = [(s['expires'], sid) for sid, s in sessions_db.items()]  # куча по времени истечения
+heapq.heapify(session_expiry)
+register_store(SESSIONS_FILE, lambda: sessions_db)
+
+def sign_session(session_id):
+    return hmac.new(app.config['SECRET_KEY'].encode(), session_id.encode(), 'sha256').hexdigest()[:32]
+
+def create_session(username):
+    session_id = secrets.token_urlsafe(24)
+    expires = time.time() + SESSION_TTL
+    sessions_db[session_id] = {'username': username, 'expires': expires}
+    heapq.heappush(session_expiry, (expires, session_id))
+    mark_dirty(SESSIONS_FILE)
+    return f'{session_id}.{sign_session(session_id)}'
+
+def session_user(token):
+    """Проверяет подпись и срок токена; активную сессию продлевает."""
+    if not isinstance(token, str):
+        return None
+    session_id, _, signature = token.partition('.')
+    if not hmac.compare_digest(signature.encode(), sign_session(session_id).encode()):
+        return None
+    session = sessions_db.get(session_id)
+    now = time.time()
+    if not session or session['expires'] <= now:
+        return None
+    # Продлеваем, только когда прошла половина срока, чтобы куча не разрасталась
+    if session['expires'] - now < SESSION_TTL / 2:
+        session['expires'] = now + SESSION_TTL
+        heapq.heappush(session_expiry, (session['expires'], session_id))
+        mark_dirty(SESSIONS_FILE)
+    return session['username']
+
+def revoke_sessions(username):
+    for session_id in [sid for sid, s in sessions_db.items() if s['username'] == username]:
+        del sessions_db[session_id]
+        mark_dirty(SESSIONS_FILE)
+
+def sweep_sessions():
+    """Удаляет истёкшие сессии; sessions.json запишет фоновый сброс."""
+    now = time.time()
+    while session_expiry and session_expiry[0][0] <= now:
+        expires, session_id = heapq.heappop(session_expiry)
+        session = sessions_db.get(session_id)
+        if session and session['expires'] <= now:
+            del sessions_db[session_id]
+            mark_dirty(SESSIONS_FILE)
+
+def session_sweeper():
+    while True:
+        socketio.sleep(SESSION_SWEEP_INTERVAL)
+        sweep_sessions()
+
+socketio.start_background_task(session_sweeper)
 
 # ============ АВТОВХОД ============
 @socketio.on('auto_login')
-def handle_auto_login():
-    if request.sid in sessions_db:
-        username = sessions_db[request.sid]
-        if username in users_db and username not in banned_db:
-            online_users[request.sid] = username
-            update_last_seen(username)
-            join_room('general')
-            
-            emit('history', messages_db['general'][-100:])
-            
-            emit('login_success', {
-                'username': username,
-                'display_name': users_db[username].get('display_name', username),
-                'avatar': users_db[username]['avatar'],
-                'is_admin': users_db[username].get('is_admin', False),
-                'friends': friends_db.get(username, {}).get('friends', []),
-                'pending_in': friends_db.get(username, {}).get('pending_in', []),
-                'blocked': blocked_db.get(username, [])
-            })
-            
-            send({
-                'username': '🔵 Система',
-                'msg': f'✨ С возвращением, {users_db[username]["display_name"]} (@{username})!',
-                'time': datetime.now().strftime('%H:%M'),
-                'type': 'system'
-            }, room='general')
-            
-            broadcast_user_list()
-            emit('all_users', get_all_users(username), room=request.sid)
-            return True
+def handle_auto_login(data=None):
+    data = data or {}
+    username = session_user(data.get('token'))
+    if username in users_db and username not in banned_db:
+        enter_chat(username, f'✨ С возвращением, {users_db[username]["display_name"]} (@{username})!',
+                   resume=data if data.get('room') else None, users_version=data.get('users_version'))
+        return True
     return False
 
 # ============ ПОИСК ============
 @socketio.on('search_users')
+@limit_rate('search_users', expensive=True)
 def handle_search(data):
     if request.sid not in online_users:
         return
@@ -328,7 +1178,7 @@ def handle_friend_request(data):
     
     friends_db[from_user]['pending_out'].append(to_user)
     friends_db[to_user]['pending_in'].append(from_user)
-    save_json(FRIENDS_FILE, friends_db)
+    mark_dirty(FRIENDS_FILE)
     
     emit('friend_request_sent', {'to': to_user})
     
@@ -357,7 +1207,7 @@ def handle_accept_friend(data):
     friends_db[current_user]['friends'].append(from_user)
     friends_db[from_user]['friends'].append(current_user)
     
-    save_json(FRIENDS_FILE, friends_db)
+    mark_dirty(FRIENDS_FILE)
     
     emit('friend_request_accepted', {'username': from_user}, room=request.sid)
     emit('friends_updated', {
@@ -385,7 +1235,7 @@ def handle_reject_friend(data):
     if from_user in friends_db[current_user]['pending_in']:
         friends_db[current_user]['pending_in'].remove(from_user)
         friends_db[from_user]['pending_out'].remove(current_user)
-        save_json(FRIENDS_FILE, friends_db)
+        mark_dirty(FRIENDS_FILE)
         emit('friend_request_rejected', {'username': from_user}, room=request.sid)
         
         for sid, user in online_users.items():
@@ -402,7 +1252,7 @@ def handle_create_group(data):
     creator = online_users[request.sid]
     group_name = data.get('name', f"Группа @{creator}")
     
-    group_id = f"group_{int(datetime.now().timestamp())}_{creator}"
+    group_id = new_group_id()
     groups_db[group_id] = {
         'id': group_id,
         'name': group_name,
@@ -412,12 +1262,13 @@ def handle_create_group(data):
         'created': datetime.now().isoformat(),
         'avatar': '👥'
     }
-    save_json(GROUPS_FILE, groups_db)
+    index_group(group_id)
+    mark_dirty(GROUPS_FILE)
     
     if 'groups' not in messages_db:
         messages_db['groups'] = {}
     messages_db['groups'][group_id] = []
-    save_json(MESSAGES_FILE, messages_db)
+    mark_dirty(MESSAGES_FILE)
     
     emit('group_created', {'id': group_id, 'name': group_name})
 
@@ -427,18 +1278,18 @@ def handle_get_groups():
         return
     
     username = online_users[request.sid]
-    user_groups = []
-    for gid, group in groups_db.items():
-        if username in group['members']:
-            user_groups.append({
-                'id': gid, 
-                'name': group['name'], 
-                'avatar': group.get('avatar', '👥'),
-                'members': group['members'],
-                'admins': group['admins'],
-                'creator': group['creator']
-            })
-    emit('groups_list', user_groups)
+    groups_list = []
+    for gid in sorted(user_groups.get(username, ())):
+        group = groups_db[gid]
+        groups_list.append({
+            'id': gid, 
+            'name': group['name'], 
+            'avatar': group.get('avatar', '👥'),
+            'members': group['members'],
+            'admins': group['admins'],
+            'creator': group['creator']
+        })
+    emit('groups_list', groups_list)
 
 @socketio.on('add_to_group')
 def handle_add_to_group(data):
@@ -452,15 +1303,21 @@ def handle_add_to_group(data):
     if group_id not in groups_db:
         return
     
-    group = groups_db[group_id]
-    
-    if username not in group['admins'] and username != group['creator']:
+    if not is_group_admin(group_id, username):
         emit('group_error', {'msg': '❌ Нет прав'})
         return
     
-    if user_to_add not in group['members']:
-        group['members'].append(user_to_add)
-        save_json(GROUPS_FILE, groups_db)
+    if user_to_add not in users_db:
+        emit('group_error', {'msg': '❌ Пользователь не найден'})
+        return
+    
+    if user_to_add in banned_db:
+        emit('group_error', {'msg': '❌ Пользователь заблокирован'})
+        return
+    
+    if add_group_member(group_id, user_to_add):
+        invalidate_room(group_id)
+        mark_dirty(GROUPS_FILE)
         emit('group_member_added', {'group_id': group_id, 'username': user_to_add}, room=group_id)
 
 @socketio.on('remove_from_group')
@@ -475,18 +1332,17 @@ def handle_remove_from_group(data):
     if group_id not in groups_db:
         return
     
-    group = groups_db[group_id]
-    
-    if username not in group['admins'] and username != group['creator']:
+    if not is_group_admin(group_id, username):
         emit('group_error', {'msg': '❌ Нет прав'})
         return
     
-    if user_to_remove in group['members'] and user_to_remove != group['creator']:
-        group['members'].remove(user_to_remove)
-        if user_to_remove in group['admins']:
-            group['admins'].remove(user_to_remove)
-        save_json(GROUPS_FILE, groups_db)
+    if user_to_remove != groups_db[group_id]['creator'] and remove_group_member(group_id, user_to_remove):
+        invalidate_room(group_id)
+        mark_dirty(GROUPS_FILE)
         emit('group_member_removed', {'group_id': group_id, 'username': user_to_remove}, room=group_id)
+        for sid, user in online_users.items():
+            if user == user_to_remove:
+                leave_room(group_id, sid=sid)
 
 @socketio.on('update_group')
 def handle_update_group(data):
@@ -503,7 +1359,7 @@ def handle_update_group(data):
     
     group = groups_db[group_id]
     
-    if username not in group['admins'] and username != group['creator']:
+    if not is_group_admin(group_id, username):
         emit('group_error', {'msg': '❌ Нет прав'})
         return
     
@@ -512,7 +1368,7 @@ def handle_update_group(data):
     if new_avatar:
         group['avatar'] = new_avatar
     
-    save_json(GROUPS_FILE, groups_db)
+    mark_dirty(GROUPS_FILE)
     emit('group_updated', {'group_id': group_id, 'name': group['name'], 'avatar': group['avatar']}, room=group_id)
 
 @socketio.on('delete_group')
@@ -532,12 +1388,19 @@ def handle_delete_group(data):
         emit('group_error', {'msg': '❌ Только создатель может удалить группу'})
         return
     
+    drop_room_media(group_id, materialize(group_id, messages_db.get('groups', {}).get(group_id, [])))
+    unindex_group(group_id)
+    invalidate_room(group_id)
     del groups_db[group_id]
     if 'groups' in messages_db and group_id in messages_db['groups']:
         del messages_db['groups'][group_id]
+    room_bytes.pop(group_id, None)
+    pending_changes.pop(group_id, None)
+    room_events.pop(group_id, None)
+    drop_archive(group_id)
     
-    save_json(GROUPS_FILE, groups_db)
-    save_json(MESSAGES_FILE, messages_db)
+    mark_dirty(GROUPS_FILE)
+    mark_dirty(MESSAGES_FILE)
     emit('group_deleted', {'group_id': group_id}, room=group_id)
 
 # ============ БЛОКИРОВКА ============
@@ -554,12 +1417,13 @@ def handle_block_user(data):
     
     if user_to_block not in blocked_db[current_user]:
         blocked_db[current_user].append(user_to_block)
-        save_json(BLOCKED_FILE, blocked_db)
+        invalidate_rooms(current_user, user_to_block)
+        mark_dirty(BLOCKED_FILE)
         
         if user_to_block in friends_db[current_user]['friends']:
             friends_db[current_user]['friends'].remove(user_to_block)
             friends_db[user_to_block]['friends'].remove(current_user)
-            save_json(FRIENDS_FILE, friends_db)
+            mark_dirty(FRIENDS_FILE)
         
         emit('user_blocked', {'username': user_to_block})
 
@@ -573,7 +1437,8 @@ def handle_unblock_user(data):
     
     if user_to_unblock in blocked_db[current_user]:
         blocked_db[current_user].remove(user_to_unblock)
-        save_json(BLOCKED_FILE, blocked_db)
+        invalidate_rooms(current_user, user_to_unblock)
+        mark_dirty(BLOCKED_FILE)
         emit('user_unblocked', {'username': user_to_unblock})
 
 # ============ БАН (только для SENATOR) ============
@@ -599,13 +1464,17 @@ def handle_ban_user(data):
         'banned_by': admin_user,
         'time': datetime.now().isoformat()
     }
-    save_json(BANNED_FILE, banned_db)
-    
-    for sid, user in list(online_users.items()):
-        if user == user_to_ban:
-            emit('banned', {'reason': reason, 'contact': '@SENATOR_DANIIL'}, room=sid)
-            online_users.pop(sid, None)
-            leave_room(sid, 'general')
+    mark_dirty(BANNED_FILE)
+    refresh_directory(user_to_ban)
+    invalidate_rooms(user_to_ban)
+    revoke_sessions(user_to_ban)
+    
+    for sid in list(user_sids.get(user_to_ban, ())):
+        emit('banned', {'reason': reason, 'contact': '@SENATOR_DANIIL'}, room=sid)
+        set_offline(sid)
+        for room_id in rooms(sid=sid):
+            if room_id != sid:
+                leave_room(room_id, sid=sid)
     
     emit('user_banned', {'username': user_to_ban}, broadcast=True)
 
@@ -616,43 +1485,26 @@ def handle_delete_message(data):
         return
     
     username = online_users[request.sid]
-    message_id = data.get('id')
-    room = data.get('room')
+    message_id = parse_message_id(data.get('id'))
+    room = resolve_room(data.get('room'))
     is_admin = users_db[username].get('is_admin', False)
     
-    if room.startswith('private_'):
-        if 'private' in messages_db and room in messages_db['private']:
-            for i, msg in enumerate(messages_db['private'][room]):
-                if msg['id'] == message_id:
-                    # Админ может удалить любое, обычный пользователь - только своё
-                    if is_admin or msg['username'] == username:
-                        messages_db['private'][room].pop(i)
-                        save_json(MESSAGES_FILE, messages_db)
-                        emit('message_deleted', {'id': message_id, 'room': room}, room=room)
-                    break
-    elif room.startswith('group_'):
-        if 'groups' in messages_db and room in messages_db['groups']:
-            for i, msg in enumerate(messages_db['groups'][room]):
-                if msg['id'] == message_id:
-                    if is_admin or msg['username'] == username:
-                        messages_db['groups'][room].pop(i)
-                        save_json(MESSAGES_FILE, messages_db)
-                        emit('message_deleted', {'id': message_id, 'room': room}, room=room)
-                    break
-    else:
-        if room in messages_db:
-            for i, msg in enumerate(messages_db[room]):
-                if msg['id'] == message_id:
-                    if is_admin or msg['username'] == username:
-                        messages_db[room].pop(i)
-                        save_json(MESSAGES_FILE, messages_db)
-                        emit('message_deleted', {'id': message_id, 'room': room}, room=room)
-                    break
+    if not room or not can_read(room, username) or message_id is None:
+        return
+    
+    msg = find_message(room, message_id)
+    # Админ может удалить любое, обычный пользователь - только своё
+    if msg and (is_admin or msg['username'] == username):
+        event = append_event(room.id, 'delete', id=message_id)
+        if msg.get('media'):
+            drop_media(msg['media'])
+        emit('message_deleted', {'id': message_id, 'room': room.id, 'seq': event['seq']}, room=room.id)
 
 # ============ ОЧИСТКА ЧАТА (ИСПРАВЛЕНО) ============
 clear_requests = {}
 
 @socketio.on('request_clear_chat')
+@limit_rate('request_clear_chat')
 def handle_request_clear_chat(data):
     if request.sid not in online_users:
         return
@@ -660,11 +1512,12 @@ def handle_request_clear_chat(data):
     user1 = online_users[request.sid]
     user2 = data.get('with_user')
     
-    if not user2:
+    # Очистка пишет событие и отметки прочтения — только для настоящего собеседника
+    if not user2 or user2 == user1 or user2 not in users_db:
         return
     
-    chat_id = f"private_{min(user1, user2)}_{max(user1, user2)}"
-    request_id = f"{min(user1, user2)}_{max(user1, user2)}"
+    chat_id = private_room_id(user1, user2)
+    request_id = chat_id
     
     if request_id not in clear_requests:
         # Первый запрос
@@ -675,13 +1528,19 @@ def handle_request_clear_chat(data):
                 emit('clear_chat_requested', {'from': user1, 'chat': chat_id}, room=sid)
                 break
     else:
-        # Второй пользователь согласился
-        if user2 in clear_requests[request_id] or user1 in clear_requests[request_id]:
-            if chat_id in messages_db.get('private', {}):
-                messages_db['private'][chat_id] = []
-                save_json(MESSAGES_FILE, messages_db)
+        # Согласие засчитывается только от второго участника, повтор своего запроса — нет
+        if user2 in clear_requests[request_id]:
+            upto = room_seq.get(chat_id, 0)
+            # Медиа живой истории удаляем сразу, архивные — при свёртке журнала
+            room = resolve_room(chat_id)
+            for msg in materialize(chat_id, room_messages(room)) if room else ():
+                if msg.get('media'):
+                    drop_media(msg['media'])
+            event = append_event(chat_id, 'clear', upto=upto)
+            for user in (user1, user2):
+                mark_read(user, chat_id, None, upto)
             del clear_requests[request_id]
-            emit('chat_cleared', {'chat': chat_id}, room=chat_id)
+            emit('chat_cleared', {'chat': chat_id, 'seq': event['seq'], 'upto': upto}, room=chat_id)
 
 # ============ РЕДАКТИРОВАНИЕ СООБЩЕНИЯ ============
 @socketio.on('edit_message')
@@ -690,61 +1549,28 @@ def handle_edit_message(data):
         return
     
     username = online_users[request.sid]
-    message_id = data.get('id')
+    message_id = parse_message_id(data.get('id'))
     new_text = data.get('new_text')[:500]
-    room = data.get('room')
-    
-    if room.startswith('private_'):
-        if 'private' in messages_db and room in messages_db['private']:
-            for msg in messages_db['private'][room]:
-                if msg['id'] == message_id and msg['username'] == username:
-                    msg_time = datetime.fromtimestamp(msg['id'])
-                    if datetime.now() - msg_time < timedelta(minutes=5):
-                        msg['msg'] = new_text
-                        msg['edited'] = True
-                        msg['edit_time'] = datetime.now().strftime('%H:%M')
-                        save_json(MESSAGES_FILE, messages_db)
-                        emit('message_edited', {
-                            'id': message_id,
-                            'new_text': new_text,
-                            'room': room,
-                            'edit_time': msg['edit_time']
-                        }, room=room)
-                    break
-    elif room.startswith('group_'):
-        if 'groups' in messages_db and room in messages_db['groups']:
-            for msg in messages_db['groups'][room]:
-                if msg['id'] == message_id and msg['username'] == username:
-                    msg_time = datetime.fromtimestamp(msg['id'])
-                    if datetime.now() - msg_time < timedelta(minutes=5):
-                        msg['msg'] = new_text
-                        msg['edited'] = True
-                        msg['edit_time'] = datetime.now().strftime('%H:%M')
-                        save_json(MESSAGES_FILE, messages_db)
-                        emit('message_edited', {
-                            'id': message_id,
-                            'new_text': new_text,
-                            'room': room,
-                            'edit_time': msg['edit_time']
-                        }, room=room)
-                    break
-    else:
-        if room in messages_db:
-            for msg in messages_db[room]:
-                if msg['id'] == message_id and msg['username'] == username:
-                    msg_time = datetime.fromtimestamp(msg['id'])
-                    if datetime.now() - msg_time < timedelta(minutes=5):
-                        msg['msg'] = new_text
-                        msg['edited'] = True
-                        msg['edit_time'] = datetime.now().strftime('%H:%M')
-                        save_json(MESSAGES_FILE, messages_db)
-                        emit('message_edited', {
-                            'id': message_id,
-                            'new_text': new_text,
-                            'room': room,
-                            'edit_time': msg['edit_time']
-                        }, room=room)
-                    break
+    room = resolve_room(data.get('room'))
+    
+    if not room or not can_read(room, username) or message_id is None:
+        return
+    
+    msg = find_message(room, message_id)
+    if not msg or msg['username'] != username:
+        return
+    
+    msg_time = datetime.fromtimestamp(msg['id'])
+    if datetime.now() - msg_time < timedelta(minutes=5):
+        event = append_event(room.id, 'edit', id=message_id, msg=new_text,
+                             edit_time=datetime.now().strftime('%H:%M'))
+        emit('message_edited', {
+            'id': message_id,
+            'new_text': new_text,
+            'room': room.id,
+            'edit_time': event['edit_time'],
+            'seq': event['seq']
+        }, room=room.id)
 
 # ============ СОХРАНЕНИЕ ФАЙЛА ============
 @socketio.on('save_file')
@@ -759,81 +1585,922 @@ def handle_save_file(data):
         # Отправляем файл для скачивания
         emit('file_saved', {'file_data': file_data, 'filename': filename}, room=request.sid)
 
+# ============ ПЕЧАТАЕТ / ПРОЧИТАНО ============
+TYPING_TTL = 5               # сколько секунд держится «печатает» без новых событий
+TYPING_DEBOUNCE = 2          # повторные typing чаще этого не обрабатываются
+ACTIVITY_FLUSH_INTERVAL = 1  # как часто рассылается сводка по комнатам
+READS_SAVE_INTERVAL = 10
+
+typing_state = {}   # room id -> {username: срок}
+read_updates = {}   # room id -> {username: seq}, ещё не разосланные отметки
+activity_dirty = set()
+# username -> {room id: {'id': последнее прочитанное, 'seq': его номер}}
+reads_db = load_json(READS_FILE, {})
+for markers in reads_db.values():
+    for room_id in [r for r in markers if r in legacy_private_ids]:
+        marker = markers.pop(room_id)
+        new_id = legacy_private_ids[room_id]
+        if marker['seq'] > markers.get(new_id, {}).get('seq', 0):
+            markers[new_id] = marker
+register_store(READS_FILE, lambda: reads_db, interval=READS_SAVE_INTERVAL)
+if legacy_private_ids:
+    mark_dirty(READS_FILE)
+
+def stop_typing(username, room_id):
+    if typing_state.get(room_id, {}).pop(username, None):
+        activity_dirty.add(room_id)
+
+def mark_read(username, room_id, msg_id, seq):
+    """Двигает отметку прочтения только вперёд; True, если она изменилась."""
+    markers = reads_db.setdefault(username, {})
+    if markers.get(room_id, {}).get('seq', 0) >= seq:
+        return False
+    markers[room_id] = {'id': msg_id, 'seq': seq}
+    mark_dirty(READS_FILE)
+    return True
+
+def unread_counts(username):
+    rooms = ['general', *user_groups.get(username, ()), *user_dm_rooms.get(username, ())]
+    markers = reads_db.get(username, {})
+    counts = {}
+    for room_id in rooms:
+        unread = room_seq.get(room_id, 0) - markers.get(room_id, {}).get('seq', 0)
+        if unread > 0:
+            counts[room_id] = unread
+    return counts
+
+@socketio.on('typing')
+def handle_typing(data):
+    if request.sid not in online_users:
+        return
+    
+    username = online_users[request.sid]
+    room = resolve_room(data.get('room'))
+    if not room or not can_write(room, username):
+        return
+    
+    if data.get('stop'):
+        stop_typing(username, room.id)
+        return
+    
+    users = typing_state.setdefault(room.id, {})
+    now = time.monotonic()
+    expires = users.get(username)
+    if expires and expires - now > TYPING_TTL - TYPING_DEBOUNCE:
+        return
+    if not expires:
+        activity_dirty.add(room.id)
+    users[username] = now + TYPING_TTL
+
+@socketio.on('read_up_to')
+def handle_read_up_to(data):
+    if request.sid not in online_users:
+        return
+    
+    username = online_users[request.sid]
+    room = resolve_room(data.get('room'))
+    message_id = data.get('id')
+    if not room or not can_read(room, username):
+        return
+    
+    # Отмечают почти всегда последние сообщения — ищем с конца
+    for msg in reversed(room_messages(room)):
+        if msg['id'] == message_id:
+            if mark_read(username, room.id, message_id, msg['seq']) and room.kind != 'general':
+                read_updates.setdefault(room.id, {})[username] = msg['seq']
+                activity_dirty.add(room.id)
+            break
+
+def flush_activity():
+    """Одна сводка на комнату: кто печатает и чьи отметки прочтения сдвинулись."""
+    now = time.monotonic()
+    for room_id, users in list(typing_state.items()):
+        expired = [u for u, expires in users.items() if expires <= now]
+        for u in expired:
+            del users[u]
+        if expired:
+            activity_dirty.add(room_id)
+        if not users:
+            del typing_state[room_id]
+    
+    for room_id in activity_dirty:
+        socketio.emit('room_activity', {
+            'room': room_id,
+            'typing': sorted(typing_state.get(room_id, ())),
+            'read': read_updates.pop(room_id, {})
+        }, room=room_id)
+    activity_dirty.clear()
+
+def room_reads(room):
+    """Отметки прочтения всех участников комнаты — клиент по ним ставит ✓✓ своим сообщениям."""
+    return {u: reads_db.get(u, {}).get(room.id, {}).get('seq', 0) for u in room.members}
+
+def activity_loop():
+    while True:
+        socketio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        flush_activity()
+
+socketio.start_background_task(activity_loop)
+
+# ============ ОФЛАЙН-ДОСТАВКА ============
+INBOX_MAX = 2000          # больше не храним: самые старые отбрасываются
+INBOX_SLACK = 500         # файл обрезается, только когда перерос INBOX_MAX на столько
+INBOX_MAX_BYTES = 1024 * 1024  # и по размеру файла очереди
+
+# Номер в очереди: микросекунды на старте, дальше +1 — растёт и между перезапусками
+inbox_counter = itertools.count(time.time_ns() // 1000)
+offline_inbox = {}  # username -> состояние очереди, см. inbox_state
+dirty_inboxes = set()  # у кого есть записи, ещё не дописанные в файл
+
+# В очереди лежит только ссылка {key, seq, room, id}: текст один на всех в истории комнаты,
+# а правки и удаления, сделанные пока получатель был офлайн, он увидит уже применёнными.
+# Старые записи с полем message (копия сообщения) отдаются как есть.
+# Новые записи копятся в памяти и дописываются в файлы отложенной записью — одной
+# дозаписью на пользователя за сброс, вне хаба, — а не по файлу на сообщение и участника.
+
+def inbox_path(username):
+    return os.path.join(INBOX_FOLDER, hashlib.sha1(username.encode()).hexdigest() + '.jsonl')
+
+def inbox_state(username):
+    """Очередь пользователя; при первом обращении подхватывает то, что уже лежит на диске."""
+    state = offline_inbox.get(username)
+    if state is None:
+        state = {'unwritten': [], 'keys': set(), 'spilled': 0, 'bytes': 0, 'dropped': False}
+        if os.path.exists(inbox_path(username)):
+            for entry in read_spilled(username):
+                state['keys'].add(entry['key'])
+                state['spilled'] += 1
+            state['bytes'] = os.path.getsize(inbox_path(username))
+        offline_inbox[username] = state
+    return state
+
+def read_spilled(username):
+    if not os.path.exists(inbox_path(username)):
+        return []
+    entries = []
+    with open(inbox_path(username), 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # строка, недописанная при падении
+    return entries
+
+def trim_inbox(username, state):
+    """Оставляет в файле самые новые записи в пределах INBOX_MAX и трёх четвертей INBOX_MAX_BYTES."""
+    lines, size = [], 0
+    for entry in reversed(read_spilled(username)):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        if len(lines) >= INBOX_MAX or size + len(line.encode()) > INBOX_MAX_BYTES * 3 // 4:
+            break
+        lines.append(line)
+        size += len(line.encode())
+    lines.reverse()
+    with open(inbox_path(username), 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+    state['keys'] = {json.loads(line)['key'] for line in lines} | {e['key'] for e in state['unwritten']}
+    state['spilled'] = len(lines)
+    state['bytes'] = size
+    state['dropped'] = True
+
+def append_inboxes(batch):
+    for username, lines in batch.items():
+        with open(inbox_path(username), 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+
+def flush_inboxes():
+    """Дописывает накопленное; переросший файл обрезается с запасом, а не на каждую запись."""
+    batch = {}
+    for username in dirty_inboxes:
+        state = offline_inbox.get(username)
+        if state and state['unwritten']:
+            batch[username] = [json.dumps(e, ensure_ascii=False) + '\n' for e in state['unwritten']]
+            state['unwritten'] = []
+    dirty_inboxes.clear()
+    if not batch:
+        return
+    run_blocking(append_inboxes, batch)
+    for username, lines in batch.items():
+        state = offline_inbox[username]  # drain_inbox ждёт конца сброса, так что очередь на месте
+        state['spilled'] += len(lines)
+        state['bytes'] += sum(len(line.encode()) for line in lines)
+        if state['spilled'] > INBOX_MAX + INBOX_SLACK or state['bytes'] > INBOX_MAX_BYTES:
+            trim_inbox(username, state)
+
+register_store(INBOX_FOLDER, flush=flush_inboxes)
+
+def enqueue_offline(room, msg_data):
+    """Кладёт ссылку на сообщение в очередь каждому участнику комнаты, у кого нет ни одного сокета."""
+    key = f"{room.id}:{msg_data['id']}"
+    for member in room.members:
+        if member == msg_data['username'] or member in user_sids:
+            continue
+        state = inbox_state(member)
+        if key in state['keys']:
+            continue
+        state['keys'].add(key)
+        state['unwritten'].append({'key': key, 'seq': next(inbox_counter), 'room': room.id, 'id': msg_data['id']})
+        dirty_inboxes.add(member)
+        mark_dirty(INBOX_FOLDER)
+
+def resolve_inbox(username, entries):
+    """Достаёт сообщения по ссылкам: живая история комнаты, затем её архив — по сегменту за раз."""
+    wanted = {}
+    for entry in entries:
+        if 'message' not in entry:
+            wanted.setdefault(entry['room'], set()).add(entry['id'])
+    found = {}
+    for room_id, ids in wanted.items():
+        room = resolve_room(room_id)
+        if room is None or not can_read(room, username):
+            continue  # группа удалена или пользователя из неё исключили
+        live = [m for m in room_messages(room) if m['id'] in ids]
+        missing = ids - {m['id'] for m in live}
+        archived = []
+        for path in {segment_path(room_id, message_id) for message_id in missing}:
+            archived.extend(m for m in fold_segment(path).values() if m['id'] in missing)
+        for msg in materialize(room_id, archived + live):
+            found[(room_id, msg['id'])] = msg
+    messages = []
+    for entry in entries:
+        msg = entry['message'] if 'message' in entry else found.get((entry['room'], entry['id']))
+        if msg is not None:
+            messages.append(msg)
+    return messages
+
+def drain_inbox(username):
+    """Забирает всю очередь пользователя одним списком в порядке поступления."""
+    if username not in offline_inbox and not os.path.exists(inbox_path(username)):
+        return [], False
+    # Во время сброса файл дописывается вне хаба — ждём, чтобы не удалить его из-под записи
+    with file_locks.setdefault(INBOX_FOLDER, PoolSemaphore(1)):
+        state = inbox_state(username)
+        entries = {entry['key']: entry for entry in read_spilled(username)}
+        entries.update((entry['key'], entry) for entry in state['unwritten'])
+        del offline_inbox[username]
+        dirty_inboxes.discard(username)
+        if os.path.exists(inbox_path(username)):
+            os.remove(inbox_path(username))
+    return resolve_inbox(username, sorted(entries.values(), key=lambda e: e['seq'])), state['dropped']
+
+# ============ ХРАНЕНИЕ И АРХИВ ============
+# Лимиты живой истории по типу комнаты; None — без ограничения.
+# Переопределяются в retention.json: {"private": {"count": 500}}
+RETENTION = {
+    'general': {'count': 100, 'age_days': None, 'bytes': 20 * 1024 * 1024},
+    'private': {'count': 100, 'age_days': None, 'bytes': 20 * 1024 * 1024},
+    'group': {'count': 100, 'age_days': None, 'bytes': 20 * 1024 * 1024},
+}
+for kind, limits in load_json(RETENTION_FILE, {}).items():
+    RETENTION.setdefault(kind, {}).update(limits)
+RETENTION_INTERVAL = 10 * 60
+RETENTION_SLACK = 0.2  # сработавший лимит сбрасывает историю с запасом: до 80% от него
+HISTORY_PAGE = 100
+
+# Вытесненные сообщения дописываются в archive/<комната>/<день>.jsonl.gz.
+# Сегмент только растёт: правка — новая запись с тем же id, удаление — {'id', 'deleted'};
+# при чтении побеждает последняя запись, компактор переписывает сегмент начисто.
+# Пока сегмент сжимается, в него можно дописывать: хвост переносится в новый файл.
+dirty_segments = set()
+segments_busy = set()  # сегменты, которые сейчас сжимаются
+
+def parse_message_id(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def message_size(msg):
+    return len(msg.get('msg') or '')
+
+def room_kind(room_id):
+    if room_id.startswith('private_'):
+        return 'private'
+    if room_id.startswith('group_'):
+        return 'group'
+    return 'general'
+
+room_bytes = {room_id: sum(map(message_size, messages)) for room_id, messages in iter_room_lists()}
+
+def archive_dir(room_id):
+    return os.path.join(ARCHIVE_FOLDER, f"{secure_filename(room_id)[:60]}_{hashlib.sha1(room_id.encode()).hexdigest()[:8]}")
+
+def segment_path(room_id, message_id):
+    day = datetime.fromtimestamp(message_id).strftime('%Y-%m-%d')
+    return os.path.join(archive_dir(room_id), f'{day}.jsonl.gz')
+
+def archive_append(room_id, records):
+    by_segment = {}
+    for record in records:
+        by_segment.setdefault(segment_path(room_id, record['id']), []).append(record)
+    os.makedirs(archive_dir(room_id), exist_ok=True)
+    for path, chunk in by_segment.items():
+        with gzip.open(path, 'at', encoding='utf-8') as f:
+            for record in chunk:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def is_segment(name):
+    return name.endswith('.jsonl.gz')
+
+def segment_records(path, size=None):
+    """Записи сегмента (первые size байт); оборванный при падении хвост пропускается."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as raw:
+        data = raw.read() if size is None else raw.read(size)
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        except (EOFError, OSError, zlib.error):
+            return
+
+def fold_records(records):
+    folded = {}
+    for record in records:
+        if record.get('deleted'):
+            folded.pop(record['id'], None)
+        else:
+            folded[record['id']] = record
+    return dict(sorted(folded.items()))
+
+def fold_segment(path):
+    """Сообщения сегмента по id с учётом правок и удалений, в порядке id."""
+    return fold_records(segment_records(path))
+
+def archived_message(room_id, message_id):
+    return fold_segment(segment_path(room_id, message_id)).get(message_id)
+
+def read_archive(room_id, before, limit):
+    """До limit сообщений старше before, читая сегменты от новых к старым."""
+    if not os.path.isdir(archive_dir(room_id)):
+        return []
+    page = []
+    for name in sorted(filter(is_segment, os.listdir(archive_dir(room_id))), reverse=True):
+        older = [m for m in fold_segment(os.path.join(archive_dir(room_id), name)).values() if m['id'] < before]
+        page = older[-(limit - len(page)):] + page
+        if len(page) >= limit:
+            break
+    return page
+
+def drop_archive(room_id):
+    shutil.rmtree(archive_dir(room_id), ignore_errors=True)
+
+# Архивы личных чатов со старыми id переносим под новые; gzip-члены можно просто склеить
+for old_id, new_id in legacy_private_ids.items():
+    if os.path.isdir(archive_dir(old_id)):
+        os.makedirs(archive_dir(new_id), exist_ok=True)
+        for name in filter(is_segment, os.listdir(archive_dir(old_id))):
+            with open(os.path.join(archive_dir(old_id), name), 'rb') as src, \
+                 open(os.path.join(archive_dir(new_id), name), 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+        drop_archive(old_id)
+
+def enforce_retention(room_id, messages):
+    """Вытесняет в архив самые старые сообщения сверх лимитов; последнее остаётся всегда."""
+    limits = RETENTION[room_kind(room_id)]
+    cutoff = time.time() - limits['age_days'] * 86400 if limits.get('age_days') else None
+    size = room_bytes.get(room_id, 0)
+    count, max_bytes = limits.get('count'), limits.get('bytes')
+    # Без запаса полная комната вытесняла бы по сообщению на каждое новое — отдельный
+    # gzip-член и запись на хабе на каждую отправку. С запасом — одна пачка на RETENTION_SLACK лимита.
+    if (count and len(messages) > count) or (max_bytes and size > max_bytes):
+        count = count and count - int(count * RETENTION_SLACK)
+        max_bytes = max_bytes and max_bytes - int(max_bytes * RETENTION_SLACK)
+    evict = 0
+    while evict < len(messages) - 1:
+        msg = messages[evict]
+        if (count and len(messages) - evict > count) or \
+           (max_bytes and size > max_bytes) or \
+           (cutoff and msg['id'] < cutoff):
+            size -= message_size(msg)
+            evict += 1
+        else:
+            break
+    if evict:
+        archive_append(room_id, messages[:evict])
+        del messages[:evict]
+        room_bytes[room_id] = size
+    return evict
+
+def write_compacted(path, size, tmp, keep=None):
+    """Сворачивает первые size байт сегмента в tmp; False, если записей не осталось."""
+    folded = fold_records(segment_records(path, size))
+    if keep:
+        folded = {msg_id: msg for msg_id, msg in folded.items() if keep(msg)}
+    if not folded:
+        return False
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+        for record in folded.values():
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return True
+
+def compact_segment(path, keep=None, offload=False):
+    """Переписывает сегмент начисто; offload — свёртка в системном потоке (не в пуле хешей).
+    
+    Сжатия одного сегмента идут строго по очереди. Записи, дописанные во время
+    сжатия, лежат за снятым размером и переносятся в новый файл до подмены —
+    archive_append работает на хабе, так что между переносом и rename ничего не вклинится.
+    """
+    while path in segments_busy:
+        socketio.sleep(0.05)
+    if not os.path.exists(path):
+        return
+    segments_busy.add(path)
+    tmp = f'{path}.{secrets.token_hex(4)}.tmp'
+    try:
+        size = os.path.getsize(path)
+        job = functools.partial(write_compacted, path, size, tmp, keep)
+        kept = run_blocking(job) if offload else job()
+        with open(path, 'rb') as f:
+            f.seek(size)
+            tail = f.read()
+        if not kept and not tail:
+            os.remove(path)
+            return
+        with open(tmp, 'ab') as f:
+            f.write(tail)
+        os.replace(tmp, path)
+    finally:
+        segments_busy.discard(path)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def retention_loop():
+    """Фоном: вытеснение по возрасту в тихих комнатах и сжатие сегментов с правками."""
+    while True:
+        socketio.sleep(RETENTION_INTERVAL)
+        evicted = sum(enforce_retention(room_id, messages) for room_id, messages in iter_room_lists())
+        if evicted:
+            mark_dirty(MESSAGES_FILE)
+        while dirty_segments:
+            compact_segment(dirty_segments.pop(), offload=True)
+
+socketio.start_background_task(retention_loop)
+
+# ============ ЖУРНАЛ ИЗМЕНЕНИЙ ============
+# Правки, удаления и очистки не трогают историю сразу, а пишутся событиями с номером
+# в events.jsonl. Клиент догоняет комнату с последнего известного номера, а компактор
+# периодически сворачивает события в messages.json и архив.
+EVENT_LOG_KEEP = 500          # свёрнутых событий на комнату держим для догоняющих клиентов
+EVENTS_COMPACT_INTERVAL = 60
+EVENTS_COMPACT_PENDING = 500  # или раньше, если несвёрнутых событий накопилось столько
+
+room_events = {}      # room id -> {'seq': последнее событие, 'folded': последнее свёрнутое, 'log': [события]}
+pending_changes = {}  # room id -> несвёрнутые изменения: deleted, edited, cleared_upto
+pending_total = 0
+
+def messages_for(room_id):
+    if room_kind(room_id) == 'general':
+        return messages_db.get(room_id)
+    return messages_db.get('private' if room_kind(room_id) == 'private' else 'groups', {}).get(room_id)
+
+def index_pending(room_id, event):
+    changes = pending_changes.setdefault(room_id, {'deleted': set(), 'edited': {}, 'media': {}, 'cleared_upto': 0})
+    if event['type'] == 'delete':
+        changes['deleted'].add(event['id'])
+        changes['edited'].pop(event['id'], None)
+    elif event['type'] == 'edit':
+        changes['edited'][event['id']] = event
+    elif event['type'] == 'media':
+        changes['media'][event['id']] = event['media']
+    elif event['type'] == 'clear':
+        changes['cleared_upto'] = max(changes['cleared_upto'], event['upto'])
+
+def append_event(room_id, event_type, **fields):
+    global pending_total
+    state = room_events.setdefault(room_id, {'seq': 0, 'log': []})
+    state['seq'] += 1
+    event = {'seq': state['seq'], 'type': event_type, **fields}
+    state['log'].append(event)
+    index_pending(room_id, event)
+    pending_total += 1
+    with open(EVENTS_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'room': room_id, **event}, ensure_ascii=False) + '\n')
+    return event
+
+def event_seq(room_id):
+    return room_events.get(room_id, {}).get('seq', 0)
+
+def materialize(room_id, messages, changes=None):
+    """Применяет несвёрнутые события (или переданные changes) к списку сообщений, не меняя его."""
+    changes = changes or pending_changes.get(room_id)
+    if not changes:
+        return messages
+    view = []
+    for msg in messages:
+        if msg.get('seq', 0) <= changes['cleared_upto'] or msg['id'] in changes['deleted']:
+            continue
+        edit = changes['edited'].get(msg['id'])
+        if edit:
+            msg = {**msg, 'msg': edit['msg'], 'edited': True, 'edit_time': edit['edit_time']}
+        media = changes['media'].get(msg['id'])
+        if media:
+            msg = {**msg, 'media': media}
+        view.append(msg)
+    return view
+
+def room_history(room, limit=100):
+    return materialize(room.id, room_messages(room)[-limit:])
+
+def find_message(room, message_id):
+    """Текущее состояние сообщения — из живой истории или архива, с учётом событий."""
+    msg = next((m for m in room_messages(room) if m['id'] == message_id), None)
+    if msg is None:
+        msg = archived_message(room.id, message_id)
+    view = materialize(room.id, [msg]) if msg else []
+    return view[0] if view else None
+
+def room_sync(room, since, after):
+    """События после since и сообщения после seq after; None, если разрыв не восполнить."""
+    state = room_events.get(room.id, {'seq': 0, 'log': []})
+    if since > state['seq'] or (since < state['seq'] and (not state['log'] or state['log'][0]['seq'] > since + 1)):
+        return None
+    messages = room_messages(room)
+    first_seq = messages[0]['seq'] if messages else room_seq.get(room.id, 0) + 1
+    if after < first_seq - 1:
+        return None
+    return {
+        'room': room.id,
+        'events': [e for e in state['log'] if e['seq'] > since],
+        'messages': materialize(room.id, [m for m in messages if m['seq'] > after]),
+        'seq': state['seq']
+    }
+
+def fold_events():
+    """Сворачивает накопленные события в messages.json и архив, журнал переписывается."""
+    global pending_total
+    # Дальше запись уходит с хаба, а компактор ждёт занятые сегменты — пока он уступает,
+    # приходят новые события. Поэтому сворачиваем ровно то, что накопилось к этому моменту:
+    # живую историю правим сразу, изменения забираем из pending_changes и запоминаем seq.
+    batch = {}
+    for room_id in list(pending_changes):
+        messages = messages_for(room_id)
+        base_ids = set()
+        if messages is not None:
+            base_ids = {m['id'] for m in messages}
+            messages[:] = materialize(room_id, messages)
+            room_bytes[room_id] = sum(map(message_size, messages))
+        batch[room_id] = (pending_changes.pop(room_id), base_ids, room_events[room_id]['seq'])
+    folded_total = pending_total
+    
+    for room_id, (changes, base_ids, _) in batch.items():
+        if room_id not in room_events:
+            continue  # группу удалили, пока шла свёртка
+        if changes['cleared_upto'] and os.path.isdir(archive_dir(room_id)):
+            upto = changes['cleared_upto']
+            for name in filter(is_segment, os.listdir(archive_dir(room_id))):
+                path = os.path.join(archive_dir(room_id), name)
+                for msg in fold_segment(path).values():
+                    if msg.get('media') and msg.get('seq', 0) <= upto:
+                        drop_media(msg['media'])
+                compact_segment(path, keep=lambda m: m.get('seq', 0) > upto)
+        for message_id in changes['deleted'] - base_ids:
+            archive_append(room_id, [{'id': message_id, 'deleted': True}])
+            dirty_segments.add(segment_path(room_id, message_id))
+        for message_id in (changes['edited'].keys() | changes['media'].keys()) - base_ids:
+            msg = archived_message(room_id, message_id)
+            patched = materialize(room_id, [msg], changes) if msg else []
+            if patched:
+                archive_append(room_id, patched)
+                dirty_segments.add(segment_path(room_id, message_id))
+    
+    pending_total -= folded_total
+    # Сначала история, потом журнал: иначе при падении события пометятся свёрнутыми зря
+    flush_store(MESSAGES_FILE)
+    for room_id, (_, _, upto_seq) in batch.items():
+        if room_id in room_events:
+            room_events[room_id]['folded'] = upto_seq
+    
+    # В журнале остаётся хвост свёрнутых событий — для догоняющих клиентов — и всё,
+    # что пришло во время свёртки: оно остаётся несвёрнутым и при падении восстановится
+    tmp = EVENTS_FILE + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for room_id, state in room_events.items():
+            folded = state.get('folded', 0)
+            log = state['log']
+            state['log'] = [e for i, e in enumerate(log) if i >= len(log) - EVENT_LOG_KEEP or e['seq'] > folded]
+            for event in state['log'] or [{'seq': state['seq'], 'type': 'marker'}]:
+                f.write(json.dumps({'room': room_id, **event, 'folded': event['seq'] <= folded},
+                                   ensure_ascii=False) + '\n')
+    os.replace(tmp, EVENTS_FILE)
+
+def events_loop():
+    last_fold = time.monotonic()
+    while True:
+        socketio.sleep(1)
+        if pending_total and (pending_total >= EVENTS_COMPACT_PENDING or
+                              time.monotonic() - last_fold >= EVENTS_COMPACT_INTERVAL):
+            fold_events()
+            last_fold = time.monotonic()
+
+# Восстанавливаем журнал: свёрнутые события — только хвост для синхронизации,
+# несвёрнутые (сервер упал до компакции) снова становятся ожидающими.
+_events_migrated = False
+if os.path.exists(EVENTS_FILE):
+    with open(EVENTS_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue  # недописанная строка при падении
+            room_id = event.pop('room')
+            if canonical_room_id(room_id) != room_id:
+                room_id = canonical_room_id(room_id)
+                _events_migrated = True
+            folded = event.pop('folded', False)
+            state = room_events.setdefault(room_id, {'seq': 0, 'log': []})
+            state['seq'] = max(state['seq'], event['seq'])
+            if folded:
+                state['folded'] = max(state.get('folded', 0), event['seq'])
+            if event['type'] == 'marker':
+                continue
+            state['log'].append(event)
+            if not folded:
+                index_pending(room_id, event)
+                pending_total += 1
+# Журнал со старыми id личных чатов сразу переписываем под новые
+if _events_migrated:
+    fold_events()
+
+socketio.start_background_task(events_loop)
+
+# ============ ОБРАБОТКА МЕДИА ============
+# Оригинал из data URL сразу сохраняется в uploads/media, а сообщение уходит со ссылкой
+# и статусом pending. Превью, заглушку и постер для видео фоновые воркеры строят
+# в пуле процессов и досылают событием media_ready; оригинал клиент грузит по клику.
+MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS', 2))
+MEDIA_QUEUE_SIZE = 200
+MEDIA_RETRIES = 2
+MEDIA_STAGE_TIMEOUT = 30
+THUMB_SIZE = (320, 320)
+PLACEHOLDER_GRID = (4, 3)
+FFMPEG = shutil.which('ffmpeg')
+# Отдаются inline только эти типы; остальное (SVG, HTML, XHTML…) — вложением,
+# иначе скрипт из файла выполнится на нашем домене и прочитает токен сессии
+MEDIA_INLINE_TYPES = {
+    'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp',
+    'video/mp4': '.mp4', 'video/webm': '.webm', 'video/ogg': '.ogv', 'video/quicktime': '.mov',
+    'audio/mpeg': '.mp3', 'audio/ogg': '.ogg', 'audio/wav': '.wav', 'audio/webm': '.weba', 'audio/mp4': '.m4a',
+}
+MEDIA_INLINE_EXTENSIONS = {ext: mime for mime, ext in MEDIA_INLINE_TYPES.items()}
+MEDIA_INLINE_EXTENSIONS['.jpeg'] = 'image/jpeg'
+DATA_URL = re.compile(r'data:([\w.+-]+/[\w.+-]+)(?:;[\w=.+-]+)*;base64,', re.A)
+
+media_queue = deque()
+media_metrics = {}  # этап -> {'ok', 'failed', 'total_ms', 'max_ms'}
+_media_executor = None
+
+def media_executor():
+    # При monkey patching eventlet форк процессов ненадёжен — тогда хватает потоков
+    global _media_executor
+    if _media_executor is None:
+        patched = False
+        if tpool:
+            from eventlet import patcher
+            patched = patcher.is_monkey_patched('thread')
+        if patched:
+            _media_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS)
+        else:
+            _media_executor = ProcessPoolExecutor(max_workers=MEDIA_WORKERS,
+                                                  mp_context=multiprocessing.get_context('fork'))
+    return _media_executor
+
+def media_url(name):
+    return f'/media/{name}'
+
+def decode_data_url(data_url, start, path):
+    try:
+        payload = base64.b64decode(data_url[start:], validate=True)
+    except ValueError:
+        return False
+    with open(path, 'wb') as f:
+        f.write(payload)
+    return True
+
+def store_media(data_url):
+    """Сохраняет data URL в файл и возвращает описание медиа; None, если это не base64."""
+    match = DATA_URL.match(data_url)
+    if not match:
+        return None
+    mime = match.group(1).lower()
+    inline = mime in MEDIA_INLINE_TYPES
+    kind = mime.split('/', 1)[0] if inline else 'file'
+    ext = MEDIA_INLINE_TYPES[mime] if inline else secure_filename(mimetypes.guess_extension(mime) or '') or '.bin'
+    name = uuid.uuid4().hex + (ext if ext.startswith('.') else '.' + ext)
+    if not run_blocking(decode_data_url, data_url, match.end(), os.path.join(MEDIA_FOLDER, name)):
+        return None
+    return {'type': kind, 'mime': mime, 'url': media_url(name),
+            'thumb': None, 'poster': None, 'placeholder': None,
+            'status': 'pending' if kind in ('image', 'video') else 'ready'}
+
+def drop_media(media):
+    """Удаляет оригинал и производные файлы: по старой ссылке их больше не скачать."""
+    for url in (media.get('url'), media.get('thumb'), media.get('poster')):
+        if url and url.startswith('/media/'):
+            path = os.path.join(MEDIA_FOLDER, secure_filename(url.rsplit('/', 1)[1]))
+            if os.path.exists(path):
+                os.remove(path)
+
+def drop_room_media(room_id, messages):
+    """Медиа живой истории и архива комнаты — перед удалением комнаты целиком."""
+    for msg in messages:
+        if msg.get('media'):
+            drop_media(msg['media'])
+    if os.path.isdir(archive_dir(room_id)):
+        for name in filter(is_segment, os.listdir(archive_dir(room_id))):
+            for msg in fold_segment(os.path.join(archive_dir(room_id), name)).values():
+                if msg.get('media'):
+                    drop_media(msg['media'])
+
+def make_thumbnail(source, target):
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img.thumbnail(THUMB_SIZE)
+        img.save(target, 'JPEG', quality=70, optimize=True)
+        return img.size
+
+def make_placeholder(source):
+    """Сетка средних цветов 4x3 — клиент размывает её, пока грузится превью."""
+    with Image.open(source) as img:
+        small = img.convert('RGB').resize(PLACEHOLDER_GRID, Image.BOX)
+        colors = ['#%02x%02x%02x' % small.getpixel((x, y))
+                  for y in range(PLACEHOLDER_GRID[1]) for x in range(PLACEHOLDER_GRID[0])]
+        return {'cols': PLACEHOLDER_GRID[0], 'colors': colors, 'ratio': round(img.width / img.height, 3)}
+
+def make_poster(source, target):
+    subprocess.run([FFMPEG, '-y', '-loglevel', 'error', '-ss', '1', '-i', source,
+                    '-frames:v', '1', target], check=True, timeout=MEDIA_STAGE_TIMEOUT)
+    if not os.path.exists(target):
+        # Ролик короче секунды — берём первый кадр
+        subprocess.run([FFMPEG, '-y', '-loglevel', 'error', '-i', source,
+                        '-frames:v', '1', target], check=True, timeout=MEDIA_STAGE_TIMEOUT)
+    return target
+
+def record_stage(stage, started, ok):
+    elapsed = (time.perf_counter() - started) * 1000
+    metrics = media_metrics.setdefault(stage, {'ok': 0, 'failed': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+    metrics['ok' if ok else 'failed'] += 1
+    metrics['total_ms'] += elapsed
+    metrics['max_ms'] = max(metrics['max_ms'], elapsed)
+
+def run_stage(stage, fn, *args):
+    """Этап в пуле с таймаутом и повторами; None, если все попытки упали."""
+    for attempt in range(MEDIA_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            future = media_executor().submit(fn, *args)
+            result = run_blocking(future.result, MEDIA_STAGE_TIMEOUT)
+        except Exception as e:
+            record_stage(stage, started, ok=False)
+            print(f'⚠️ media {stage}: {e!r} (попытка {attempt + 1})')
+            socketio.sleep(0.5 * 2 ** attempt)
+        else:
+            record_stage(stage, started, ok=True)
+            return result
+    return None
+
+def enqueue_media(room_id, message_id, media):
+    if len(media_queue) >= MEDIA_QUEUE_SIZE:
+        # Очередь переполнена: превью не будет, оригинал доступен по ссылке
+        return {**media, 'status': 'ready'}
+    media_queue.append({'room': room_id, 'id': message_id, 'media': media})
+    return media
+
+def process_media(job):
+    media = dict(job['media'])
+    name = media['url'].rsplit('/', 1)[1]
+    source = os.path.join(MEDIA_FOLDER, name)
+    stem = name.rsplit('.', 1)[0]
+    
+    if media['type'] == 'video':
+        poster = FFMPEG and run_stage('poster', make_poster, source, os.path.join(MEDIA_FOLDER, stem + '_poster.jpg'))
+        if poster:
+            media['poster'] = media_url(stem + '_poster.jpg')
+        source = poster
+    
+    if source and Image is not None:
+        thumb = os.path.join(MEDIA_FOLDER, stem + '_thumb.jpg')
+        if run_stage('thumbnail', make_thumbnail, source, thumb):
+            media['thumb'] = media_url(stem + '_thumb.jpg')
+            media['placeholder'] = run_stage('placeholder', make_placeholder, thumb)
+    
+    media['status'] = 'ready'
+    return media
+
+def media_worker():
+    while True:
+        if not media_queue:
+            socketio.sleep(0.2)
+            continue
+        job = media_queue.popleft()
+        started = time.perf_counter()
+        media = process_media(job)
+        record_stage('total', started, ok=media['thumb'] is not None or media['poster'] is not None)
+        
+        room = resolve_room(job['room'])
+        if room is None or find_message(room, job['id']) is None:
+            # Сообщение удалили, пока строились превью
+            drop_media(media)
+            continue
+        event = append_event(room.id, 'media', id=job['id'], media=media)
+        socketio.emit('media_ready', {'room': room.id, 'id': job['id'], 'media': media, 'seq': event['seq']},
+                      room=room.id)
+
+# Задания, не доделанные до перезапуска, ставим в очередь заново
+for room_id, messages in iter_room_lists():
+    for msg in materialize(room_id, messages):
+        if (msg.get('media') or {}).get('status') == 'pending':
+            media_queue.append({'room': room_id, 'id': msg['id'], 'media': msg['media']})
+
+for _ in range(MEDIA_WORKERS):
+    socketio.start_background_task(media_worker)
+
+@app.route('/media/<name>')
+def media_file(name):
+    mime = MEDIA_INLINE_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+    response = send_from_directory(MEDIA_FOLDER, name, max_age=365 * 24 * 3600,
+                                   mimetype=mime or 'application/octet-stream', as_attachment=mime is None)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@app.route('/media_stats')
+def media_stats():
+    return jsonify({'queue': len(media_queue), 'stages': media_metrics})
+
 # ============ СООБЩЕНИЯ ============
 @socketio.on('message')
+@limit_rate('message', media_cost=message_media_cost, expensive=True)
 def handle_message(data):
     if request.sid not in online_users:
         return
     
     username = online_users[request.sid]
     msg = data['msg']
-    room = data.get('room', 'general')
+    room_id = data.get('room', 'general')
     reply_to = data.get('reply_to')
     
     if username in banned_db:
         emit('banned', {'reason': banned_db[username].get('reason', '')}, room=request.sid)
         return
     
-    if msg and (msg.startswith('data:image') or msg.startswith('data:video') or 
-                msg.startswith('data:audio') or msg.startswith('data:application')):
+    if is_media(msg):
         if len(msg) > 70 * 1024 * 1024:
             emit('message_error', {'msg': '❌ Файл слишком большой'})
             return
     
+    room = resolve_room(room_id)
+    if not room or not can_read(room, username):
+        emit('message_error', {'msg': '❌ Нет доступа к чату'})
+        return
+    
+    if not can_write(room, username):
+        emit('message_error', {'msg': '❌ Пользователь заблокирован'})
+        return
+    
+    media = None
+    if is_media(msg):
+        media = store_media(msg)
+        if media is None:
+            emit('message_error', {'msg': '❌ Файл повреждён или в неизвестном формате'})
+            return
+        msg = ''
+    
     msg_data = {
         'id': datetime.now().timestamp(),
         'username': username,
         'display_name': users_db[username]['display_name'],
         'msg': msg,
         'time': datetime.now().strftime('%H:%M'),
-        'room': room,
+        'room': room.id,
         'avatar': users_db[username]['avatar'],
         'is_admin': users_db[username].get('is_admin', False),
         'reply_to': reply_to,
-        'edited': False
+        'edited': False,
+        'seq': room_seq.get(room.id, 0) + 1
     }
-    
-    if room.startswith('private_'):
-        parts = room.replace('private_', '').split('_')
-        user1, user2 = parts[0], parts[1]
-        
-        if (username == user1 and user2 in blocked_db.get(user1, [])) or \
-           (username == user2 and user1 in blocked_db.get(user2, [])):
-            emit('message_error', {'msg': '❌ Пользователь заблокирован'})
-            return
-        
-        if 'private' not in messages_db:
-            messages_db['private'] = {}
-        if room not in messages_db['private']:
-            messages_db['private'][room] = []
-        
-        messages_db['private'][room].append(msg_data)
-        if len(messages_db['private'][room]) > 100:
-            messages_db['private'][room].pop(0)
-        
-        send(msg_data, room=room)
-    elif room.startswith('group_'):
-        if 'groups' not in messages_db:
-            messages_db['groups'] = {}
-        if room not in messages_db['groups']:
-            messages_db['groups'][room] = []
-        
-        messages_db['groups'][room].append(msg_data)
-        if len(messages_db['groups'][room]) > 100:
-            messages_db['groups'][room].pop(0)
-        
-        send(msg_data, room=room)
-    else:
-        if room not in messages_db:
-            messages_db[room] = []
-        
-        messages_db[room].append(msg_data)
-        if len(messages_db[room]) > 100:
-            messages_db[room].pop(0)
-        
-        send(msg_data, room=room)
-    
-    save_json(MESSAGES_FILE, messages_db)
+    if media:
+        msg_data['media'] = enqueue_media(room.id, msg_data['id'], media) if media['status'] == 'pending' else media
+    room_seq[room.id] = msg_data['seq']
+    if room.kind == 'private':
+        for member in room.members:
+            user_dm_rooms.setdefault(member, set()).add(room.id)
+    mark_read(username, room.id, msg_data['id'], msg_data['seq'])
+    stop_typing(username, room.id)
+    
+    messages = room_messages(room, create=True)
+    messages.append(msg_data)
+    journal_append(MESSAGES_FILE, msg_data)
+    room_bytes[room.id] = room_bytes.get(room.id, 0) + message_size(msg_data)
+    enforce_retention(room.id, messages)
+    
+    send(msg_data, room=room.id)
+    if room.kind != 'general':
+        enqueue_offline(room, msg_data)
 
 # ============ РЕДАКТИРОВАНИЕ ПРОФИЛЯ ============
 @socketio.on('update_profile')
@@ -845,12 +2512,17 @@ def handle_update_profile(data):
     new_avatar = data.get('avatar')
     new_display_name = data.get('display_name')
     
+    if new_avatar and rate_limit_exceeded('upload_avatar', len(new_avatar)):
+        return
+    
     if new_avatar:
         users_db[username]['avatar'] = new_avatar
     if new_display_name:
         users_db[username]['display_name'] = new_display_name
     
-    save_json(USERS_FILE, users_db)
+    mark_dirty(USERS_FILE)
+    refresh_directory(username)
+    online_list[username] = user_list_entry(username)
     
     for sid, user in online_users.items():
         emit('profile_updated', {
@@ -866,42 +2538,70 @@ def handle_join_room(data):
         return
     
     username = online_users[request.sid]
-    new_room = data['room']
-    old_room = data.get('old_room', 'general')
+    new_room = resolve_room(data.get('room'))
+    old_room = resolve_room(data.get('old_room', 'general'))
     
-    if old_room != new_room:
-        leave_room(old_room)
-        join_room(new_room)
-        
-        if new_room.startswith('private_'):
-            if 'private' in messages_db and new_room in messages_db['private']:
-                emit('history', messages_db['private'][new_room][-100:])
-        elif new_room.startswith('group_'):
-            if 'groups' in messages_db and new_room in messages_db['groups']:
-                emit('history', messages_db['groups'][new_room][-100:])
-        else:
-            emit('history', messages_db.get(new_room, [])[-100:])
+    if not new_room or not can_read(new_room, username):
+        emit('room_error', {'msg': '❌ Нет доступа к чату'})
+        return
+    
+    if not old_room or old_room.id != new_room.id:
+        if old_room:
+            leave_room(old_room.id)
+        join_room(new_room.id)
+        send_room_state(new_room, data.get('since'), data.get('after'))
+
+def send_room_state(room, since=None, after=None):
+    """Если клиент знает, на чём остановился, шлёт только изменения, иначе всю историю."""
+    sync = room_sync(room, since, after) if isinstance(since, int) and isinstance(after, int) else None
+    if sync:
+        emit('room_events', sync)
+    else:
+        emit('history', room_history(room))
+        emit('room_sync', {'room': room.id, 'seq': event_seq(room.id)})
+    # В общем чате отметки не рассылаются; в остальных — сразу текущие, дальше приходят сдвиги
+    if room.kind != 'general':
+        emit('room_activity', {
+            'room': room.id,
+            'typing': sorted(typing_state.get(room.id, ())),
+            'read': room_reads(room)
+        })
 
 # ============ ПОЛУЧИТЬ ИСТОРИЮ ============
 @socketio.on('get_history')
 def handle_get_history(data):
-    room = data.get('room', 'general')
-    if room.startswith('private_'):
-        if 'private' in messages_db and room in messages_db['private']:
-            emit('history', messages_db['private'][room][-100:])
-    elif room.startswith('group_'):
-        if 'groups' in messages_db and room in messages_db['groups']:
-            emit('history', messages_db['groups'][room][-100:])
-    else:
-        emit('history', messages_db.get(room, [])[-100:])
+    if request.sid not in online_users:
+        return
+    
+    room = resolve_room(data.get('room', 'general'))
+    if not room or not can_read(room, online_users[request.sid]):
+        return
+    
+    before = parse_message_id(data.get('before'))
+    if before is None:
+        send_room_state(room)
+        return
+    
+    # Страница старше before: сначала живой хвост, недостающее — из архива
+    page = [m for m in room_messages(room) if m['id'] < before][-HISTORY_PAGE:]
+    if len(page) < HISTORY_PAGE:
+        oldest = page[0]['id'] if page else before
+        page = read_archive(room.id, oldest, HISTORY_PAGE - len(page)) + page
+    page = materialize(room.id, page)
+    emit('history_page', {'room': room.id, 'before': before, 'messages': page})
 
 # ============ ДИСКОННЕКТ ============
 @socketio.on('disconnect')
 def handle_disconnect():
+    forget_sid_limits(request.sid)
     if request.sid in online_users:
-        username = online_users[request.sid]
+        username = set_offline(request.sid)
         update_last_seen(username)
-        del online_users[request.sid]
+        if username in user_sids:
+            return
+        
+        for room_id in list(typing_state):
+            stop_typing(username, room_id)
         
         send({
             'username': '🔵 Система',
@@ -912,15 +2612,68 @@ def handle_disconnect():
         
         broadcast_user_list()
 
+# ============ ЖИЗНЕННЫЙ ЦИКЛ ============
+# SIGTERM/SIGINT: новые подключения отклоняются, клиентам уходит просьба переподключиться,
+# журнал сворачивается, грязные хранилища и очереди офлайн-доставки пишутся на диск.
+# SIGHUP: то же самое, затем процесс перезапускает себя через exec на том же порту.
+SHUTDOWN_GRACE = 1  # секунд на доставку уведомления клиентам
+
+shutting_down = False
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    if shutting_down:
+        return False
+
+def persist_state():
+    """Сбрасывает на диск всё, что живёт только в памяти."""
+    if pending_total:
+        fold_events()
+    flush_stores(force=True)
+
+def shutdown(restart=False):
+    socketio.emit('server_restart', {'msg': '🔄 Сервер перезапускается, переподключаемся...'})
+    socketio.sleep(SHUTDOWN_GRACE)
+    started = time.perf_counter()
+    persist_state()
+    if _media_executor is not None:
+        _media_executor.shutdown(wait=False, cancel_futures=True)
+    print(f'💾 Состояние сохранено за {(time.perf_counter() - started) * 1000:.0f} мс')
+    if restart:
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    os._exit(0)
+
+def handle_signal(signum, frame):
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    print(f'🛑 Получен {signal.Signals(signum).name}, останавливаемся')
+    socketio.start_background_task(shutdown, signum == getattr(signal, 'SIGHUP', None))
+
+def install_signal_handlers(restart=False):
+    signals = [signal.SIGTERM, signal.SIGINT]
+    if restart and hasattr(signal, 'SIGHUP'):
+        signals.append(signal.SIGHUP)
+    for signum in signals:
+        signal.signal(signum, handle_signal)
+
+# Под gunicorn модуль импортируется в главном потоке воркера уже после его обработчиков
+if threading.current_thread() is threading.main_thread():
+    install_signal_handlers()
+
 # ============ ЗАПУСК ============
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    # Горячий перезапуск только для самостоятельного запуска: под gunicorn SIGHUP — забота мастера
+    install_signal_handlers(restart=True)
     print('=' * 60)
     print('🚀 SENAT MESSENGER v10.0 - НА RENDER')
     print('=' * 60)
     print(f'📊 Пользователей: {len(users_db)}')
     print(f'👥 Групп: {len(groups_db)}')
     print(f'👑 Админ: SENATOR')
+    print(f'⏱️ Состояние загружено за {(time.perf_counter() - BOOT_STARTED) * 1000:.0f} мс')
     print('=' * 60)
     print(f'📱 Сервер запущен на порту {port}')
     print('=' * 60)